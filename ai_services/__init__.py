@@ -1,7 +1,7 @@
 """
 服务注册和路由设置
 """
-from typing import Dict, Type
+from typing import Any, Dict, Optional, Tuple, Type
 from aiohttp import web
 
 # 服务注册表
@@ -20,13 +20,49 @@ def get_all_services() -> Dict[str, Type['BaseService']]:
     """获取所有已注册的服务"""
     return _services
 
+# 服务实例缓存: service_id -> (配置版本, 服务实例)
+_service_instances: Dict[str, Tuple[Any, 'BaseService']] = {}
+
+def get_service_instance(service_id: str) -> Optional['BaseService']:
+    """
+    获取已按配置初始化的共享服务实例
+    
+    每个服务只保留一个实例，配置文件变化后重新创建。
+    实例在并发请求间共享，请求级参数应通过 CallOptions 传入而不是修改实例。
+    
+    Args:
+        service_id: 服务ID
+        
+    Returns:
+        服务实例，服务不存在时返回 None
+    """
+    from .config_api import load_config, get_config_version
+    
+    service_class = get_service(service_id)
+    if not service_class:
+        return None
+    
+    version = get_config_version(service_id)
+    cached = _service_instances.get(service_id)
+    if cached and cached[0] == version and isinstance(cached[1], service_class):
+        return cached[1]
+    
+    service = service_class()
+    service.configure(load_config(service_id))
+    _service_instances[service_id] = (version, service)
+    return service
+
 # 导入服务基类
-from .integrations.base import BaseService
+from .integrations.base import BaseService, CallOptions
 
 # 导入具体服务实现
 from .integrations.g4f_service import G4FService
 from .integrations.qianwen_service import QianwenService
 
+# 导入共享 HTTP 会话池
+from .utils.http_session import close_all_sessions
+from .utils.image_ingest import shutdown_image_ingestor
+
 # 导入API模块
 from . import chat_api
 from . import service_api
@@ -51,6 +87,10 @@ def setup_routes(app: web.Application) -> None:
         prompt_api.register_prompt_api(app)
         ffmpeg_api.register_ffmpeg_api(app)
         
+        # ComfyUI 关闭时释放共享的 HTTP 连接池
+        app.on_cleanup.append(close_all_sessions)
+        # 关闭图片预处理线程池
+        app.on_cleanup.append(shutdown_image_ingestor)
         
         print("ComfyUI AI Assistant: API路由注册成功")
     except Exception as e:
@@ -2,43 +2,86 @@
 聊天相关的 API 端点
 """
 from aiohttp import web
-import json
 
-from .history_api import load_history_tinydb, save_history_tinydb,get_next_message_id
+from .history_api import load_history_tinydb, save_history_tinydb,get_next_message_id, cache_rendered_content, history_writer
 from .prompt_api import load_prompt,load_prompt_data
-from . import get_service
+from . import get_service_instance
 from .utils.html_parser import HtmlParser
 from .utils.handler_loader import load_handler_function
+from .utils.sse import format_sse_event
+from .utils.disconnect import ClientDisconnectedError, is_client_disconnected, run_until_disconnected, iter_until_disconnected
+from .utils.scheduler import QueueFullError
 
 def register_chat_api(app):
     """注册聊天相关的API路由"""
     app.router.add_post("/comfy_ai_assistant/chat", chat)
     app.router.add_post("/comfy_ai_assistant/stream_chat", stream_chat)
 
+def load_request_history(data):
+    """按请求中的 history 条数加载历史记录，未指定时返回 0"""
+    history = data.get('history', 0)
+    if isinstance(history, int) and history > 0:
+        history = load_history_tinydb(0,history)
+    return history
+
+def load_system_prompt(prompt_id):
+    """加载提示词内容，并附加提示词运行函数的输出"""
+    prompt = None
+    if prompt_id and prompt_id != "":
+        prompt = load_prompt(prompt_id)
+        formatted_response = HtmlParser.process_content_by_prompt_run(prompt_id)
+        if formatted_response:
+            prompt = prompt + "\n" + formatted_response
+    return prompt
+
+def build_history_record(data, images, prompt_id, content, partial=False):
+    """根据聊天请求和助手回复构建一条历史记录，partial 表示回复因客户端断开而不完整"""
+    prompt_data = load_prompt_data(prompt_id)
+    record = {
+        'message_id': get_next_message_id(),
+        'type': 'message',
+        'user': {
+            'content': data.get('message', ''),
+            'images': images,
+            'prompt_name': prompt_data.get('prompt_name') if prompt_data else None,
+            'prompt_id': prompt_id if prompt_id else None
+        },
+        'assistant': {
+            'content': content,
+            'images': []
+        }
+    }
+    if partial:
+        record['partial'] = True
+    return record
+
+async def write_error_event(request, response, message):
+    """向仍然连接的客户端发送错误事件和结束标记，客户端已断开时直接返回"""
+    if is_client_disconnected(request):
+        return
+    try:
+        await response.write(format_sse_event({"error": message}))
+        await response.write(format_sse_event("[DONE]"))
+    except ConnectionResetError:
+        pass
+
 async def chat(request):
     """聊天API"""
     try:
         # 获取请求数据
         data = await request.json()
         
-        # 获取服务实例
+        # 获取共享的服务实例
         service_id = data.get('service', 'g4f')
-        service_class = get_service(service_id)
-        if not service_class:
+        service = get_service_instance(service_id)
+        if not service:
             return web.json_response({"success": False, "error": "服务不存在"})
-            
-        # 创建服务实例
-        service = service_class()
         
-        # 设置参数
-        for param in ['system_prompt', 'temperature', 'max_tokens', 'timeout', 'model', 'proxy', 'api_key']:
-            if param in data:
-                getattr(service, f'set_{param}')(data[param])
+        # 请求中的覆盖参数作为本次调用参数传入，不修改共享实例
+        options = service.get_call_options(data)
         
         # 从请求中获取历史记录
-        history = data.get('history', 0)
-        if history > 0:
-            history = load_history_tinydb(0,history)
+        history = load_request_history(data)
         
         # 获取图片列表
         images = data.get('images', [])
@@ -47,23 +90,37 @@ async def chat(request):
         host_url = request.url.origin()
 
         # 初始化 prompt
-        prompt = None
         prompt_id = data.get('currentPromptId', '')
-        if prompt_id and prompt_id != "":
-            prompt = load_prompt(prompt_id)
-            formatted_response = HtmlParser.process_content_by_prompt_run(prompt_id)
-            if formatted_response:
-                prompt = prompt + "\n" + formatted_response
+        prompt = load_system_prompt(prompt_id)
         
-        # 发送消息并获取响应
-        response = await service.send_message(
-            message=data.get('message', ''),
-            stream=False,
-            images=images,
-            host_url=host_url,
-            history=history,
-            prompt=prompt
-        )
+        # 申请服务调用名额，队列已满时立即拒绝
+        try:
+            ticket = service.get_scheduler().enqueue(data.get('priority', 0))
+        except QueueFullError as e:
+            return web.json_response({'success': False, 'error': str(e)}, status=429)
+        
+        async def call_service():
+            # 排队等待执行权后发送消息
+            await ticket.wait()
+            return await service.send_message(
+                message=data.get('message', ''),
+                stream=False,
+                images=images,
+                host_url=host_url,
+                history=history,
+                prompt=prompt,
+                options=options
+            )
+        
+        # 发送消息并获取响应，客户端断开时取消排队或上游请求
+        try:
+            response = await run_until_disconnected(request, call_service())
+        except ClientDisconnectedError:
+            # 没有收到任何回复，不保存空的助手回复，避免之后作为空消息发送给上游
+            print("客户端已断开连接，已取消上游请求")
+            return web.json_response({'success': False, 'error': '客户端已断开连接'})
+        finally:
+            ticket.release()
         
         # 检查响应
         if not response:
@@ -79,26 +136,13 @@ async def chat(request):
                 'error': response
             })
         
-        prompt_data = load_prompt_data(prompt_id)
         # 格式化响应中的代码块
         if isinstance(response, str):
             try:
                 # 保存历史记录
-                save_history_tinydb({
-                    'message_id': get_next_message_id(),
-                    'type': 'message',
-                    'user': {
-                        'content': data.get('message', ''),
-                        'images': images,
-                        'prompt_name': prompt_data.get('prompt_name') if prompt_data else None,
-                        'prompt_id': prompt_id if prompt_id else None
-                        
-                    },
-                    'assistant': {
-                        'content': response,
-                        'images': []
-                    }
-                })
+                history_record = build_history_record(data, images, prompt_id, response)
+                message_id = history_record['message_id']
+                save_history_tinydb(history_record)
 
                 # 初始化处理结果变量
                 processed_result = None
@@ -106,6 +150,9 @@ async def chat(request):
                 # 检查是否有处理函数配置
                 formatted_response = HtmlParser.process_content_by_prompt(response, prompt_id)
                 
+                # 保存渲染结果，加载历史记录时直接使用
+                cache_rendered_content(message_id, response, prompt_id, formatted_response)
+                
                 # 构建响应
                 response_data = {
                     'success': True,
@@ -137,7 +184,7 @@ async def chat(request):
         })
 
 async def stream_chat(request):
-    """流式聊天API"""
+    """流式聊天API，将模型的增量输出逐段以 SSE 事件转发给客户端"""
     try:
         # 创建流式响应
         response = web.StreamResponse(
@@ -155,24 +202,19 @@ async def stream_chat(request):
             # 获取请求数据
             data = await request.json()
             
-            # 获取服务实例
+            # 获取共享的服务实例
             service_id = data.get('service', 'g4f')
-            service_class = get_service(service_id)
-            if not service_class:
-                await response.write(f'data: {json.dumps({"error": "服务不存在"})}\n\n'.encode('utf-8'))
-                await response.write(b'data: [DONE]\n\n')
+            service = get_service_instance(service_id)
+            if not service:
+                await response.write(format_sse_event({"error": "服务不存在"}))
+                await response.write(format_sse_event("[DONE]"))
                 return response
-                
-            # 创建服务实例
-            service = service_class()
             
-            # 设置参数
-            for param in ['system_prompt', 'temperature', 'max_tokens', 'timeout', 'model', 'proxy', 'api_key']:
-                if param in data:
-                    getattr(service, f'set_{param}')(data[param])
+            # 请求中的覆盖参数作为本次调用参数传入，不修改共享实例
+            options = service.get_call_options(data)
             
             # 从请求中获取历史记录
-            history = data.get('history', [])
+            history = load_request_history(data)
             
             # 获取图片列表
             images = data.get('images', [])
@@ -180,49 +222,98 @@ async def stream_chat(request):
             # 获取host_url，处理相对路径的图片
             host_url = request.url.origin()
             
+            # 初始化 prompt
+            prompt_id = data.get('currentPromptId', '')
+            prompt = load_system_prompt(prompt_id)
+            
+            # 增量格式化器：段落和代码块闭合后立即下发 HTML；配置了处理函数的提示词在结束时整体处理
+            formatter = HtmlParser.create_incremental_formatter(prompt_id)
+            chunks = []
+            final_html = None  # 处理函数模式下发的完整 HTML
+            completed = False
+            
+            # 申请服务调用名额，队列已满时立即拒绝
             try:
-                # 发送消息并获取流式响应
-                service_response = await service.send_message(
+                ticket = service.get_scheduler().enqueue(data.get('priority', 0))
+            except QueueFullError as e:
+                await response.write(format_sse_event({"error": str(e), "status": 429}))
+                await response.write(format_sse_event("[DONE]"))
+                return response
+            
+            try:
+                # 排队期间下发排队位置，获得执行权后开始调用
+                async for position in iter_until_disconnected(request, ticket.positions()):
+                    await response.write(format_sse_event({"queue_position": position}))
+                
+                # 逐段转发增量文本；write 会等待发送缓冲区排空，慢客户端会反压上游读取；
+                # 客户端断开时取消等待并关闭上游连接
+                async for delta in iter_until_disconnected(request, service.stream_message(
                     message=data.get('message', ''),
-                    stream=True,
                     images=images,
                     host_url=host_url,
-                    history=history
-                )
-                
-                if isinstance(service_response, bool):
-                    # 如果返回布尔值，说明出错了
-                    await response.write(f'data: {json.dumps({"error": "服务返回无效响应"})}\n\n'.encode('utf-8'))
-                    await response.write(b'data: [DONE]\n\n')
-                    return response
+                    history=history,
+                    prompt=prompt,
+                    options=options
+                )):
+                    chunks.append(delta)
+                    event = {"content": delta}
+                    if formatter:
+                        html = formatter.feed(delta)
+                        if html:
+                            event["html"] = html
+                    await response.write(format_sse_event(event))
                 
-                if hasattr(service_response, 'content'):
-                    # 处理流式响应
-                    async for chunk in service_response.content:
-                        if chunk:
-                            await response.write(f'data: {json.dumps({"content": chunk.decode("utf-8")})}\n\n'.encode('utf-8'))
-                elif isinstance(service_response, str):
-                    # 处理字符串响应
-                    await response.write(f'data: {json.dumps({"content": service_response})}\n\n'.encode('utf-8'))
+                # 增量模式下发剩余未闭合部分的 HTML；处理函数模式下发完整 HTML，客户端整体替换
+                if formatter:
+                    html = formatter.flush()
+                    if formatter.replace:
+                        # 内容中有引用式链接定义，已下发的 HTML 由完整渲染结果替换
+                        await response.write(format_sse_event({"html": html, "replace": True}))
+                    elif html:
+                        await response.write(format_sse_event({"html": html}))
                 else:
-                    # 处理其他类型的响应
-                    await response.write(f'data: {json.dumps({"content": str(service_response)})}\n\n'.encode('utf-8'))
+                    final_html = HtmlParser.process_content_by_prompt(''.join(chunks), prompt_id)
+                    await response.write(format_sse_event({"html": final_html, "replace": True}))
+                completed = True
+                await response.write(format_sse_event("[DONE]"))
+                return response
                 
-                await response.write(b'data: [DONE]\n\n')
+            except ConnectionResetError:
+                # 客户端已断开，无法再发送事件
+                print("客户端已断开连接，已停止流式输出")
                 return response
                 
             except Exception as e:
                 # 处理服务调用过程中的错误
-                error_message = f'data: {json.dumps({"error": f"服务调用错误: {str(e)}"})}\n\n'
-                await response.write(error_message.encode('utf-8'))
-                await response.write(b'data: [DONE]\n\n')
+                await write_error_event(request, response, f"服务调用错误: {str(e)}")
                 return response
             
+            finally:
+                ticket.release()
+                
+                # 流结束、出错或被取消时保存已收到的内容，写入由后台队列完成；
+                # 完整结束时同时缓存渲染结果：增量下发的 HTML 与完整渲染不一定相同，由写入线程重新渲染，
+                # 处理函数模式下发的即为完整渲染结果；未完成时标记为不完整
+                if chunks:
+                    try:
+                        render = None
+                        if completed:
+                            render = (prompt_id, final_html)
+                        history_writer.enqueue(
+                            build_history_record(data, images, prompt_id, ''.join(chunks), partial=not completed),
+                            render
+                        )
+                    except Exception as e:
+                        print(f"保存历史记录失败: {str(e)}")
+            
+        except ConnectionResetError:
+            # 客户端已断开，无法再发送事件
+            print("客户端已断开连接，已停止流式输出")
+            return response
+            
         except Exception as e:
             # 处理请求数据解析过程中的错误
-            error_message = f'data: {json.dumps({"error": f"请求处理错误: {str(e)}"})}\n\n'
-            await response.write(error_message.encode('utf-8'))
-            await response.write(b'data: [DONE]\n\n')
+            await write_error_event(request, response, f"请求处理错误: {str(e)}")
             return response
             
     except Exception as e:
@@ -230,4 +321,3 @@ async def stream_chat(request):
         import traceback
         traceback.print_exc()
         return web.json_response({"success": False, "error": f"响应设置错误: {str(e)}"})
-
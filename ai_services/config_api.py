@@ -2,10 +2,15 @@
 配置相关的 API 端点
 """
 from aiohttp import web
+import asyncio
+import copy
 import json
 import os
+import tempfile
+import threading
+import time
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
 
 DEFAULT_CONFIG = {
         "service": "g4f",
@@ -34,12 +39,240 @@ DEFAULT_CONFIG_ai_params = {
 # 配置文件路径
 SERVICES_CONFIG_DIR = Path(os.path.dirname(os.path.abspath(__file__)))/ "configs"
 
+# 配置文件变化检查间隔（秒），间隔内直接使用内存缓存
+CONFIG_CHECK_INTERVAL = 2.0
+
+# 配置保存防抖窗口（秒），窗口内的多次保存合并为一次写入
+CONFIG_SAVE_DEBOUNCE = 0.3
+
+
+class ConfigStore:
+    """
+    配置缓存
+    
+    在内存中保存已解析的配置，每个文件最多每 check_interval 秒检查一次
+    修改时间和大小，只有文件确实变化时才重新读取。
+    每次内容变化时版本号加一，供服务实例管理器判断是否需要重建实例。
+    尚未写入磁盘的条目（dirty）不会被磁盘上的旧内容覆盖。
+    """
+
+    def __init__(self, config_dir: Path, check_interval: float = CONFIG_CHECK_INTERVAL):
+        self.config_dir = config_dir
+        self.check_interval = check_interval
+        # service -> {'data', 'stat', 'checked_at', 'version', 'dirty'}
+        self._entries: Dict[Optional[str], Dict[str, Any]] = {}
+        # service -> 最新版本号，只增不减，丢弃缓存条目后仍然保留，避免旧版本号被重新使用
+        self._versions: Dict[Optional[str], int] = {}
+        self._lock = threading.Lock()
+
+    def get_config_file(self, service: Optional[str] = None) -> Path:
+        """获取配置文件路径，service 为 None 时对应默认配置文件"""
+        if service is None:
+            return self.config_dir / "config.json"
+        return self.config_dir / f"{service}.json"
+
+    @staticmethod
+    def _stat(config_file: Path):
+        """获取文件的 (修改时间, 大小)，文件不存在时返回 None"""
+        try:
+            stat = config_file.stat()
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _next_version(self, service: Optional[str]) -> int:
+        """分配新的版本号（需持有锁）"""
+        version = self._versions.get(service, 0) + 1
+        self._versions[service] = version
+        return version
+
+    def _get_entry(self, service: Optional[str]) -> Dict[str, Any]:
+        """获取缓存条目，必要时检查文件并重新加载（需持有锁）"""
+        now = time.monotonic()
+        entry = self._entries.get(service)
+        if entry is not None and (entry['dirty'] or now - entry['checked_at'] < self.check_interval):
+            return entry
+
+        config_file = self.get_config_file(service)
+        stat = self._stat(config_file)
+        if entry is not None and entry['stat'] == stat:
+            entry['checked_at'] = now
+            return entry
+
+        if stat is None:
+            # 文件不存在时使用默认配置
+            data = copy.deepcopy(DEFAULT_CONFIG if service is None else DEFAULT_CONFIG_ai_params)
+        else:
+            try:
+                with open(config_file, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except json.JSONDecodeError as e:
+                raise json.JSONDecodeError(f"配置文件格式错误: {config_file}", e.doc, e.pos)
+
+        entry = {
+            'data': data,
+            'stat': stat,
+            'checked_at': now,
+            'version': self._next_version(service),
+            'dirty': False
+        }
+        self._entries[service] = entry
+        return entry
+
+    def get(self, service: Optional[str] = None) -> Dict[str, Any]:
+        """获取配置副本，调用方可以自由修改"""
+        with self._lock:
+            return copy.deepcopy(self._get_entry(service)['data'])
+
+    def get_version(self, service: Optional[str] = None) -> int:
+        """获取配置版本号，内容变化时递增"""
+        with self._lock:
+            return self._get_entry(service)['version']
+
+    def set(self, service: Optional[str], data: Dict[str, Any]) -> int:
+        """
+        更新缓存并标记为待写入，整条替换以保证读取方看到一致的数据
+
+        Returns:
+            新的版本号，写入完成后传给 mark_clean
+        """
+        with self._lock:
+            entry = self._entries.get(service)
+            version = self._next_version(service)
+            self._entries[service] = {
+                'data': copy.deepcopy(data),
+                'stat': entry['stat'] if entry is not None else None,
+                'checked_at': time.monotonic(),
+                'version': version,
+                'dirty': True
+            }
+            return version
+
+    def mark_clean(self, service: Optional[str], version: int) -> None:
+        """配置文件写入完成后记录新的文件状态；期间又有新的保存时保持待写入状态"""
+        stat = self._stat(self.get_config_file(service))
+        with self._lock:
+            entry = self._entries.get(service)
+            if entry is not None and entry['version'] == version:
+                entry['stat'] = stat
+                entry['checked_at'] = time.monotonic()
+                entry['dirty'] = False
+
+    def invalidate(self, service: Optional[str]) -> None:
+        """丢弃缓存条目，下次读取时从磁盘重新加载，版本号继续递增"""
+        with self._lock:
+            self._entries.pop(service, None)
+
+
+def write_json_atomic(file_path: Path, data: Any) -> None:
+    """
+    原子写入 JSON 文件：先写同目录下的临时文件，再重命名覆盖目标文件，
+    写入中途崩溃不会留下被截断的配置文件
+
+    Args:
+        file_path: 目标文件路径
+        data: 要写入的数据
+    """
+    file_path.parent.mkdir(exist_ok=True, parents=True)
+    fd, tmp_path = tempfile.mkstemp(dir=str(file_path.parent), prefix=f".{file_path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class ConfigWriter:
+    """
+    配置写入器
+
+    保存时立即更新 ConfigStore，磁盘写入在防抖窗口结束后于线程池中执行，
+    窗口内对同一文件的多次保存只写入最后一次的内容。
+    """
+
+    def __init__(self, store: ConfigStore, debounce: float = CONFIG_SAVE_DEBOUNCE):
+        self.store = store
+        self.debounce = debounce
+        # service -> (data, version)
+        self._pending: Dict[Optional[str], Tuple[Dict[str, Any], int]] = {}
+        self._task: Optional[asyncio.Task] = None
+        # 防抖任务是否已开始写入磁盘
+        self._writing = False
+
+    def save(self, service: Optional[str], data: Dict[str, Any]) -> None:
+        """
+        保存配置。在事件循环中调用时异步写入，否则直接同步写入
+
+        Args:
+            service: 服务名称，None 表示默认配置文件
+            data: 配置数据
+        """
+        version = self.store.set(service, data)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_all({service: (copy.deepcopy(data), version)})
+            return
+
+        self._pending[service] = (copy.deepcopy(data), version)
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        """等待防抖窗口结束后写入"""
+        await asyncio.sleep(self.debounce)
+        await self._write_pending()
+
+    async def flush(self) -> None:
+        """立即写入所有待保存的配置，防抖任务正在写入时等待其完成，仍在等待时取消"""
+        task = self._task
+        if task is not None and not task.done():
+            if not self._writing:
+                task.cancel()
+            await asyncio.wait({task})
+        await self._write_pending()
+
+    async def _write_pending(self) -> None:
+        """在线程池中写入所有待保存的配置"""
+        loop = asyncio.get_running_loop()
+        self._writing = True
+        try:
+            while self._pending:
+                pending, self._pending = self._pending, {}
+                await loop.run_in_executor(None, self._write_all, pending)
+        finally:
+            self._writing = False
+
+    def _write_all(self, pending: Dict[Optional[str], Tuple[Dict[str, Any], int]]) -> None:
+        """写入一批配置文件（在线程池中执行）"""
+        for service, (data, version) in pending.items():
+            try:
+                write_json_atomic(self.store.get_config_file(service), data)
+                self.store.mark_clean(service, version)
+            except Exception as e:
+                print(f"写入配置文件失败: {str(e)}")
+                self.store.invalidate(service)
+
+
+# 全局配置缓存和写入器
+config_store = ConfigStore(SERVICES_CONFIG_DIR)
+config_writer = ConfigWriter(config_store)
+
 
 def register_config_api(app):
 
     """注册配置相关的 API 路由"""
     app.router.add_get("/comfy_ai_assistant/config", get_config)
     app.router.add_post("/comfy_ai_assistant/save_config", set_config)
+    # ComfyUI 关闭时写入尚未落盘的配置
+    app.on_cleanup.append(flush_config_writes)
     print("ComfyUI AI Assistant: 配置 API 路由已注册")
 
 async def get_config(request):
@@ -117,40 +350,36 @@ def load_config(service: Optional[str] = None) -> Dict[str, Any]:
         service: 服务名称。如果为 None，加载默认配置文件；否则加载服务相关配置文件。
 
     Returns:
-        配置数据的字典。
+        配置数据的字典（缓存副本，可自由修改）。
 
     Raises:
         FileNotFoundError: 配置文件不存在。
         json.JSONDecodeError: 配置文件格式错误。
     """
 
-    if service is None:
-        config_file = SERVICES_CONFIG_DIR / "config.json"
-            # 检查文件是否存在
-        if not config_file.exists():
-            return DEFAULT_CONFIG
-    else:
-        config_file = SERVICES_CONFIG_DIR / f"{service}.json"
-        if not config_file.exists():
-            return DEFAULT_CONFIG_ai_params
-
-    # 读取并解析配置文件
-    try:
-        with open(config_file, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except json.JSONDecodeError as e:
-        raise json.JSONDecodeError(f"配置文件格式错误: {config_file}", e.doc, e.pos)
-    
+    return config_store.get(service)
+
+
+def get_config_version(service: Optional[str] = None) -> int:
+    """获取配置版本号，配置内容变化时递增
+
+    Args:
+        service: 服务名称。如果为 None，对应默认配置文件。
+
+    Returns:
+        版本号
+    """
+    return config_store.get_version(service)
+
 
 def save_config(config):
-    """保存主配置"""
+    """保存主配置（立即更新缓存，磁盘写入合并后异步执行）"""
     try:
         service = config["service"]
-        config_file = SERVICES_CONFIG_DIR / "config.json"
-        config_service_file = SERVICES_CONFIG_DIR / f"{service}.json"
-        config_l=DEFAULT_CONFIG
+        # 基于默认配置的副本构建，不修改 DEFAULT_CONFIG
+        config_l = copy.deepcopy(DEFAULT_CONFIG)
         config_l["service"] = service
-        config_l["ai_params"] = config["ai_params"]
+        config_l["ai_params"] = copy.deepcopy(config["ai_params"])
 
         from ai_services import get_service
         service_class = get_service(service)
@@ -161,14 +390,17 @@ def save_config(config):
                 if config_l["ai_params"][feature] == "disabled" and feature not in unsupported_features:
                     config_l["ai_params"][feature] = ""
 
-        with open(config_file, 'w', encoding='utf-8') as f:
-            json.dump(config_l, f, ensure_ascii=False, indent=4)
-        with open(config_service_file, 'w', encoding='utf-8') as f:
-            json.dump(config_l["ai_params"] , f, ensure_ascii=False, indent=4)
+        config_writer.save(None, config_l)
+        config_writer.save(service, config_l["ai_params"])
         
         #print(f"保存配置成功: {config}")
         return True
     
     except Exception as e:
         print(f"保存配置失败: {str(e)}")
-        return False
\ No newline at end of file
+        return False
+
+
+async def flush_config_writes(app=None) -> None:
+    """写入所有待保存的配置，可直接注册到 aiohttp 应用的 on_cleanup 信号"""
+    await config_writer.flush()
@@ -2,11 +2,13 @@
 历史记录相关的 API 端点
 """
 from aiohttp import web
+import asyncio
+import hashlib
 import json
 import os
 from pathlib import Path
-from typing import List, Dict
-from tinydb import TinyDB, Query
+from typing import List, Dict, Optional, Tuple
+from .utils.history_store import HistoryStore, SqliteHistoryStore, migrate_tinydb_history
 from .utils.html_parser import HtmlParser
 from .utils.handler_loader import load_handler_function
 from .prompt_api import load_prompt_data
@@ -19,13 +21,15 @@ HISTORY_DIR = CURRENT_DIR / "history"
 # 确保历史记录目录存在
 HISTORY_DIR.mkdir(parents=True, exist_ok=True)
 
-# 数据库文件路径
-DB_FILE = HISTORY_DIR / "history.db"
+# 数据库文件路径（history.db 为旧版 TinyDB 文件，仅用于一次性迁移）
+DB_FILE = HISTORY_DIR / "history.sqlite3"
+TINYDB_FILE = HISTORY_DIR / "history.db"
 
 class HistoryDB:
     """历史记录数据库管理类"""
     _instance = None
-    _db = None
+    _db: HistoryStore = None
+    _tinydb_pending = False
     _last_read_position = 0
     _current_session_id = None
 
@@ -35,24 +39,27 @@ class HistoryDB:
             cls._instance = cls()
         return cls._instance
 
-    def get_db(self):
-        """获取数据库连接"""
+    def get_db(self) -> HistoryStore:
+        """获取历史记录存储"""
         if self._db is None:
             try:
-                self._db = TinyDB(str(DB_FILE), indent=4)
-                # 检查是否需要初始化
-                metadata = self._db.table('_metadata')
-                if not metadata.get(Query().key == 'last_message_id'):
-                    metadata.upsert(
-                        {'key': 'last_message_id', 'value': 0},
-                        Query().key == 'last_message_id'
-                    )
-                    #print("已创建新的历史记录数据库")
+                self._db = SqliteHistoryStore(DB_FILE)
+                self._tinydb_pending = True
             except Exception as e:
                 print(f"初始化历史记录数据库失败: {str(e)}")
                 raise e
+        if self._tinydb_pending:
+            # 导入旧版 TinyDB 历史记录，读取旧文件失败时下次获取存储时重试
+            migrate_tinydb_history(TINYDB_FILE, self._db)
+            self._tinydb_pending = not self._db.get_meta('tinydb_migrated', False)
         return self._db
 
+    def set_db(self, store: HistoryStore):
+        """替换历史记录存储实现"""
+        self.close()
+        self._db = store
+        self._tinydb_pending = False
+
     def close(self):
         """关闭数据库连接"""
         if self._db is not None:
@@ -78,6 +85,70 @@ class HistoryDB:
 # 创建全局数据库管理器实例
 db_manager = HistoryDB.get_instance()
 
+class HistoryWriter:
+    """
+    历史记录后台写入队列
+    
+    入队立即返回，记录和渲染缓存在线程池中按入队顺序写入，
+    流式响应的结束事件不必等待数据库 I/O
+    """
+    
+    def __init__(self):
+        # [(记录, 渲染结果 (prompt_id, html 或 None) 或 None)]
+        self._pending: List[Tuple[Dict, Optional[Tuple[str, Optional[str]]]]] = []
+        self._task: Optional[asyncio.Task] = None
+    
+    def enqueue(self, record: Dict, render: Optional[Tuple[str, Optional[str]]] = None) -> None:
+        """
+        加入一条待保存的记录。在事件循环中调用时后台写入，否则直接同步写入
+        
+        Args:
+            record: 历史记录，结构同 save_history_tinydb
+            render: (prompt_id, 格式化后的 HTML)，同时写入渲染缓存；HTML 为 None 时在写入线程中
+                用 process_content_by_prompt 渲染完整内容
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_all([(record, render)])
+            return
+        
+        self._pending.append((record, render))
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._drain())
+    
+    async def _drain(self) -> None:
+        """在线程池中写入所有待保存的记录"""
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            pending, self._pending = self._pending, []
+            await loop.run_in_executor(None, self._write_all, pending)
+    
+    async def flush(self) -> None:
+        """等待队列中的记录全部写入"""
+        if self._task is not None and not self._task.done():
+            await self._task
+        if self._pending:
+            await self._drain()
+    
+    def _write_all(self, pending: List[Tuple[Dict, Optional[Tuple[str, Optional[str]]]]]) -> None:
+        """写入一批记录（在线程池中执行）"""
+        for record, render in pending:
+            if save_history_tinydb(record) and render:
+                prompt_id, formatted_content = render
+                if formatted_content is None:
+                    try:
+                        formatted_content = HtmlParser.process_content_by_prompt(
+                            record['assistant']['content'], prompt_id)
+                    except Exception as e:
+                        print(f"渲染历史记录失败: {str(e)}")
+                        continue
+                cache_rendered_content(record['message_id'], record['assistant']['content'],
+                                       prompt_id, formatted_content)
+
+# 全局历史记录写入队列
+history_writer = HistoryWriter()
+
 def register_history_api(app):
     """注册历史记录相关的 API 路由"""
     try:
@@ -85,29 +156,28 @@ def register_history_api(app):
         app.router.add_post("/comfy_ai_assistant/save_history", set_history_tinydb)
         app.router.add_get("/comfy_ai_assistant/clear_history", clear_history_tinydb)
         app.router.add_get('/comfy_ai_assistant/sessions', get_sessions)
+        # ComfyUI 关闭时关闭历史记录数据库
+        app.on_cleanup.append(close_history_db)
         print("历史记录 API 路由已注册")
     except Exception as e:
         print(f"注册历史记录 API 路由失败: {e}")
 
+async def close_history_db(app=None):
+    """写入队列中的记录后关闭历史记录数据库，可直接注册到 aiohttp 应用的 on_cleanup 信号"""
+    await history_writer.flush()
+    db_manager.close()
+
 def get_next_message_id() -> int:
     """获取下一个可用的消息ID"""
     try:
-        db = db_manager.get_db()
-        metadata = db.table('_metadata')
-        current = metadata.get(Query().key == 'last_message_id')
-        if not current:
-            metadata.insert({'key': 'last_message_id', 'value': 0})
-            return 1
-        next_id = current['value'] + 1
-        metadata.update({'value': next_id}, Query().key == 'last_message_id')
-        return next_id
+        return db_manager.get_db().next_message_id()
     except Exception as e:
         print(f"获取下一个消息ID失败: {str(e)}")
         raise e
 
 async def set_history_tinydb(request):
     """
-    保存历史记录到 TinyDB
+    保存历史记录
     
     请求体格式:
     {
@@ -166,7 +236,7 @@ async def set_history_tinydb(request):
             'error': '无效的 JSON 数据'
         }, status=400)
     except Exception as e:
-        print(f"保存历史记录到 TinyDB 失败: {str(e)}")
+        print(f"保存历史记录失败: {str(e)}")
         return web.json_response({
             'success': False,
             'error': f'服务器错误: {str(e)}'
@@ -174,7 +244,7 @@ async def set_history_tinydb(request):
 
 def save_history_tinydb(data: dict) -> bool:
     """
-    保存历史记录到 TinyDB
+    保存历史记录
     
     Args:
         data: {
@@ -198,21 +268,21 @@ def save_history_tinydb(data: dict) -> bool:
         if not all(key in data for key in ['message_id', 'type', 'user', 'assistant']):
             raise ValueError("数据缺少必要字段")
             
-        # 保存记录
-        Message = Query()
-        db.upsert(data, Message.message_id == data['message_id'])
+        # 保存记录（按 message_id 插入或覆盖）
+        db.save(data)
         
         #print(f"保存历史记录成功，ID: {data['message_id']}")
         return True
         
     except Exception as e:
-        print(f"保存历史记录到 TinyDB 失败: {str(e)}")
+        print(f"保存历史记录失败: {str(e)}")
         return False
 
 async def get_history_tinydb(request):
-    """获取 TinyDB 历史记录的 API 端点"""
+    """获取历史记录的 API 端点"""
     try:
         message_id = request.query.get('message_id', '0')  # 默认为0
+        before_id = request.query.get('before')  # 分页游标：上一页最后一条记录的ID
         limit = int(request.query.get('limit', '10'))
         
         # 验证limit参数
@@ -226,7 +296,8 @@ async def get_history_tinydb(request):
         result = load_history_tinydb(
             message_id=int(message_id),
             limit=limit,
-            formatted=True
+            formatted=True,
+            before_id=int(before_id) if before_id else None
         )
         
         return web.json_response({
@@ -246,20 +317,12 @@ async def get_history_tinydb(request):
 
 async def clear_history_tinydb(request):
     """
-    清空 TinyDB 历史记录
-    通过删除并重建数据库来实现快速清理
+    清空历史记录
+    删除所有记录并重置消息ID
     """
     try:
-        db_path = HISTORY_DIR / 'history.db'
-        if db_path.exists():
-            try:
-                db_manager.close()
-            except:
-                pass
-            db_path.unlink()
-        
-        db_manager.get_db()  # 这会创建新的数据库并初始化必要的表
-        #print("历史记录数据库已重建")
+        db_manager.get_db().clear()
+        db_manager.set_last_position(0)
         
         return web.json_response({
             'success': True,
@@ -273,51 +336,41 @@ async def clear_history_tinydb(request):
             'error': str(e)
         }, status=500)
 
-def load_history_tinydb(message_id: int = None, limit: int = 10,formatted:bool=False) -> dict:
-    """从 TinyDB 加载历史记录，从指定message_id开始往前读取limit条记录"""
+def load_history_tinydb(message_id: int = None, limit: int = 10,formatted:bool=False, before_id: int = None) -> dict:
+    """
+    加载历史记录，按 message_id 倒序读取 limit 条记录（一次范围查询）
+    
+    Args:
+        message_id: 起始消息ID（包含），为空或0时从最新记录开始
+        limit: 读取条数
+        formatted: 是否格式化助手回复
+        before_id: 分页游标，上一页最后一条记录的ID（不包含），优先于 message_id
+        
+    Returns:
+        {'records': 记录列表, 'has_more': 是否还有更早的记录, 'next_id': 下一页游标}
+    """
     try:
         db = db_manager.get_db()
-        Message = Query()
-        result_records = []
         
-        # 如果message_id为空或0，获取最大ID
-        if not message_id or message_id == 0:
-            metadata = db.table('_metadata')
-            current = metadata.get(Query().key == 'last_message_id')
-            if not current:
-                db_manager.set_last_position(0)
-                return {
-                    'records': [],
-                    'has_more': False,
-                    'next_id': None
-                }
-            message_id = current['value']
+        # 计算查询上界（不包含）
+        if before_id:
+            upper_id = before_id
+        elif message_id:
+            upper_id = message_id + 1
+        else:
+            upper_id = None
         
-        # 从message_id开始往前读取limit条记录
-        current_id = message_id
-        while len(result_records) < limit and current_id > 0:
-            record = db.get((Message.message_id == current_id) & (Message.type == 'message'))
-            if record:
-                if formatted:
-                    # 获取用户消息中的prompt_id
-                    prompt_id = record['user'].get('prompt_id')
-                    
-                    # 使用新的通用处理方法
-                    record['assistant']['content'] = HtmlParser.process_content_by_prompt(
-                        record['assistant']['content'], 
-                        prompt_id
-                    )
-                
-                result_records.append(record)
-            current_id -= 1
+        # 多取一条用于判断是否还有更多记录
+        result_records = db.list_before(upper_id, limit + 1, 'message')
+        has_more = len(result_records) > limit
+        result_records = result_records[:limit]
         
-        # 设置last_position为当前message_id减去limit
-        next_position = message_id - limit
-        db_manager.set_last_position(next_position)
+        if formatted:
+            render_history_records(result_records)
         
-        # 检查是否还有更多记录
-        has_more = next_position > 0
-        next_id = next_position if has_more else None
+        # 下一页游标为本页最后一条记录的ID
+        next_id = result_records[-1]['message_id'] if has_more else None
+        db_manager.set_last_position(next_id or 0)
         
         return {
             'records': result_records,
@@ -326,18 +379,62 @@ def load_history_tinydb(message_id: int = None, limit: int = 10,formatted:bool=F
         }
             
     except Exception as e:
-        print(f"从 TinyDB 加载历史记录失败: {str(e)}")
+        print(f"加载历史记录失败: {str(e)}")
         raise e
 
+def get_render_key(content: str, formatter_version: str) -> str:
+    """渲染缓存键：格式化器版本和原始内容的哈希"""
+    return hashlib.sha256(f"{formatter_version}\0{content}".encode('utf-8')).hexdigest()
+
+def render_history_records(records: List[Dict]) -> None:
+    """
+    将记录中的助手回复替换为格式化后的 HTML
+    
+    优先使用渲染缓存，只有内容或格式化器（html_parser / 处理函数文件）变化时才重新渲染，
+    重新渲染的结果写回缓存
+    
+    Args:
+        records: 历史记录列表，原地修改
+    """
+    db = db_manager.get_db()
+    cached_renders = db.get_renders([record['message_id'] for record in records])
+    formatter_versions = {}
+    updated_renders = []
+    
+    for record in records:
+        # 获取用户消息中的prompt_id
+        prompt_id = record['user'].get('prompt_id')
+        if prompt_id not in formatter_versions:
+            formatter_versions[prompt_id] = HtmlParser.get_formatter_version(prompt_id)
+        
+        content = record['assistant']['content']
+        render_key = get_render_key(content, formatter_versions[prompt_id])
+        cached = cached_renders.get(record['message_id'])
+        if cached and cached[0] == render_key:
+            record['assistant']['content'] = cached[1]
+            continue
+        
+        # 使用新的通用处理方法
+        formatted_content = HtmlParser.process_content_by_prompt(content, prompt_id)
+        record['assistant']['content'] = formatted_content
+        updated_renders.append((record['message_id'], render_key, formatted_content))
+    
+    db.save_renders(updated_renders)
+
+def cache_rendered_content(message_id: int, content: str, prompt_id: str, formatted_content: str) -> None:
+    """保存消息的渲染结果，之后加载历史记录时无需重新格式化"""
+    try:
+        render_key = get_render_key(content, HtmlParser.get_formatter_version(prompt_id))
+        db_manager.get_db().save_renders([(message_id, render_key, formatted_content)])
+    except Exception as e:
+        print(f"保存渲染缓存失败: {str(e)}")
+
 async def get_sessions(request):
     """获取当前会话信息"""
     try:
         # 如果没有初始化，获取最新消息ID
         if db_manager.get_last_position() == 0:
-            metadata = db_manager.get_db().table('_metadata')
-            current = metadata.get(Query().key == 'last_message_id')
-            if current:
-                db_manager.set_last_position(current['value'])
+            db_manager.set_last_position(db_manager.get_db().get_last_message_id())
         
         return web.json_response({
             'success': True,
@@ -2,12 +2,55 @@
 服务基类定义
 """
 
-import base64
-import os
-from urllib.parse import urlparse
+import time
+from dataclasses import dataclass, fields, replace
 from abc import ABC, abstractmethod
 
-import aiohttp
+from ..utils.http_session import get_session, DEFAULT_LIMIT_PER_HOST
+from ..utils.scheduler import get_scheduler, DEFAULT_MAX_IN_FLIGHT, DEFAULT_MAX_QUEUED
+from ..utils.resilience import (
+    get_token_bucket, call_with_retry, is_retryable_error,
+    DEFAULT_RATE_LIMIT, DEFAULT_RATE_BURST, DEFAULT_MAX_RETRIES
+)
+from ..utils.image_ingest import (
+    image_ingestor, ImagePreprocessOptions,
+    DEFAULT_IMAGE_MAX_SIZE, DEFAULT_IMAGE_FORMAT, DEFAULT_IMAGE_QUALITY
+)
+
+
+@dataclass(frozen=True)
+class CallOptions:
+    """
+    单次调用参数（不可变）
+    
+    由共享服务实例的配置与请求中的覆盖参数合并得到，
+    send_message 只读取它，不修改服务实例，因此同一实例可被并发请求共享
+    """
+    temperature: float = 1
+    max_tokens: int = 2000
+    timeout: int = 300
+    model: str = ""
+    proxy: str = ""
+    api_key: str = ""
+
+
+# 请求可覆盖的调用参数及其类型转换
+CALL_OPTION_PARAMS = {
+    'temperature': float,
+    'max_tokens': int,
+    'timeout': int,
+    'model': str,
+    'proxy': str,
+    'api_key': str,
+}
+
+# 从配置文件应用到服务实例的参数
+CONFIG_PARAMS = list(CALL_OPTION_PARAMS) + [
+    'pool_limit_per_host', 'max_in_flight', 'max_queued',
+    'rate_limit', 'rate_burst', 'max_retries',
+    'image_max_size', 'image_format', 'image_quality'
+]
+
 
 class BaseService(ABC):
     """服务基类"""
@@ -23,6 +66,15 @@ class BaseService(ABC):
         self.api_base = ""
         self.api_type = ""
         self.api_version = ""
+        self.pool_limit_per_host = DEFAULT_LIMIT_PER_HOST
+        self.max_in_flight = DEFAULT_MAX_IN_FLIGHT
+        self.max_queued = DEFAULT_MAX_QUEUED
+        self.rate_limit = DEFAULT_RATE_LIMIT
+        self.rate_burst = DEFAULT_RATE_BURST
+        self.max_retries = DEFAULT_MAX_RETRIES
+        self.image_max_size = DEFAULT_IMAGE_MAX_SIZE
+        self.image_format = DEFAULT_IMAGE_FORMAT
+        self.image_quality = DEFAULT_IMAGE_QUALITY
     
     
     def set_temperature(self, temperature):
@@ -61,8 +113,143 @@ class BaseService(ABC):
         """设置API版本"""
         self.api_version = api_version
     
+    def set_pool_limit_per_host(self, pool_limit_per_host):
+        """设置单主机连接数上限"""
+        self.pool_limit_per_host = int(pool_limit_per_host)
+    
+    def set_max_in_flight(self, max_in_flight):
+        """设置同时进行的调用数上限"""
+        self.max_in_flight = int(max_in_flight)
+    
+    def set_max_queued(self, max_queued):
+        """设置排队请求数上限"""
+        self.max_queued = int(max_queued)
+    
+    def set_rate_limit(self, rate_limit):
+        """设置每个 API 密钥每秒请求数上限（0 表示不限速）"""
+        self.rate_limit = float(rate_limit)
+    
+    def set_rate_burst(self, rate_burst):
+        """设置每个 API 密钥的突发请求数"""
+        self.rate_burst = int(rate_burst)
+    
+    def set_max_retries(self, max_retries):
+        """设置可重试失败的最大重试次数"""
+        self.max_retries = int(max_retries)
+    
+    def set_image_max_size(self, image_max_size):
+        """设置发送图片的长边最大像素（0 表示不缩放）"""
+        self.image_max_size = int(image_max_size)
+    
+    def set_image_format(self, image_format):
+        """设置发送图片的格式（JPEG / WEBP / ORIGINAL）"""
+        self.image_format = str(image_format).upper()
+    
+    def set_image_quality(self, image_quality):
+        """设置发送图片的压缩质量"""
+        self.image_quality = int(image_quality)
+    
+    def get_image_options(self):
+        """获取图片预处理参数"""
+        return ImagePreprocessOptions(self.image_max_size, self.image_format, self.image_quality)
+    
+    def normalize_model(self, model):
+        """将模型名称转换为服务内部使用的模型标识，默认原样返回"""
+        return model
+    
+    def configure(self, config):
+        """
+        根据配置字典设置服务参数，由服务实例管理器在创建实例时调用一次
+        
+        Args:
+            config: 服务配置字典，空值和 "disabled" 会被忽略
+        """
+        if not config:
+            return
+        for param in CONFIG_PARAMS:
+            value = config.get(param)
+            if value is None or value == "" or value == "disabled":
+                continue
+            getattr(self, f'set_{param}')(value)
+    
+    def get_call_options(self, overrides=None):
+        """
+        生成本次调用使用的参数，不修改服务实例
+        
+        Args:
+            overrides: 请求中的覆盖参数字典，只取 CALL_OPTION_PARAMS 中的字段
+            
+        Returns:
+            CallOptions 对象
+        """
+        options = CallOptions(**{f.name: getattr(self, f.name) for f in fields(CallOptions)})
+        if not overrides:
+            return options
+        
+        changes = {}
+        for param, convert in CALL_OPTION_PARAMS.items():
+            value = overrides.get(param)
+            if value is None or value == "":
+                continue
+            changes[param] = convert(value)
+        if 'model' in changes:
+            changes['model'] = self.normalize_model(changes['model'])
+        return replace(options, **changes)
+    
+    def get_scheduler(self):
+        """
+        获取当前服务共享的调度器（按服务ID限制并发调用数和排队数）
+        
+        Returns:
+            ServiceScheduler 对象
+        """
+        service_id = self.get_service_info()["id"]
+        return get_scheduler(service_id, self.max_in_flight, self.max_queued)
+    
+    def is_retryable_error(self, error):
+        """判断上游错误是否可以重试，子类可扩展"""
+        return is_retryable_error(error)
+    
+    async def call_upstream(self, func, options):
+        """
+        调用上游服务：每次尝试前按 API 密钥限速，可重试的失败在 options.timeout 内退避重试
+        
+        Args:
+            func: 发起一次请求的协程函数，参数为总截止时间（time.monotonic 时间）
+            options: 本次调用参数
+            
+        Returns:
+            func 的结果
+        """
+        service_id = self.get_service_info()["id"]
+        deadline = time.monotonic() + options.timeout
+        bucket = None
+        if self.rate_limit > 0:
+            bucket = get_token_bucket(service_id, options.api_key, self.rate_limit, max(self.rate_burst, 1))
+        
+        async def attempt():
+            if bucket is not None:
+                # 限速等待同样计入总超时时间
+                await bucket.acquire(deadline)
+            return await func(deadline)
+        
+        return await call_with_retry(attempt, deadline, self.max_retries, self.is_retryable_error)
+    
+    def get_http_session(self, proxy=None):
+        """
+        获取当前服务共享的 HTTP 会话（按服务ID和代理复用连接池）
+        
+        Args:
+            proxy: 代理地址，为空时使用服务配置的代理
+        
+        Returns:
+            aiohttp.ClientSession 对象，调用方不要关闭
+        """
+        service_id = self.get_service_info()["id"]
+        return get_session(service_id, proxy if proxy is not None else self.proxy, self.pool_limit_per_host)
+    
     @abstractmethod
-    async def send_message(self, message, stream=False, images=None, host_url=None, history=None, prompt=None):
+    async def send_message(self, message, stream=False, images=None, host_url=None, history=None, prompt=None, options=None):
         """
         发送消息的抽象方法
         
@@ -73,12 +260,69 @@ class BaseService(ABC):
             host_url: 主机URL（用于处理相对路径的图片）
             history: 对话历史记录，用于保持上下文
             prompt: 系统提示词
+            options: 本次调用参数 CallOptions，为空时使用服务实例的配置
             
         Returns:
             AI 回复
         """
         raise NotImplementedError("子类必须实现send_message方法")
     
+    async def stream_message(self, message, images=None, host_url=None, history=None, prompt=None, options=None):
+        """
+        流式发送消息，逐段产出增量文本
+        
+        默认实现等待完整回复后一次性产出，支持流式输出的服务应覆盖此方法。
+        上游连接的生命周期由生成器自身管理，调用方提前停止迭代时连接随之释放。
+        
+        Args:
+            与 send_message 相同（不含 stream）
+            
+        Yields:
+            str: 增量文本
+        """
+        response = await self.send_message(
+            message, stream=False, images=images, host_url=host_url,
+            history=history, prompt=prompt, options=options
+        )
+        if response:
+            yield response
+    
+    def build_messages(self, history=None, prompt=None):
+        """
+        根据系统提示词和历史记录构建消息列表（不含当前消息）
+        
+        Args:
+            history: 历史记录，格式: {'records': [{message_id, type, user: {content}, assistant: {content}}], ...}
+            prompt: 系统提示词
+            
+        Returns:
+            list: OpenAI 格式的消息列表
+        """
+        messages = []
+        if prompt:
+            messages.append({"role": "system", "content": prompt})
+        
+        if isinstance(history, dict) and 'records' in history:
+            # 按 message_id 排序，确保消息顺序正确
+            sorted_records = sorted(history['records'], key=lambda x: x['message_id'])
+            
+            for record in sorted_records:
+                if record['type'] == 'message':
+                    # 添加用户消息
+                    if 'user' in record and 'content' in record['user']:
+                        messages.append({
+                            "role": "user",
+                            "content": record['user']['content']
+                        })
+                    
+                    # 添加助手回复（跳过客户端断开时保存的空回复）
+                    if 'assistant' in record and record['assistant'].get('content'):
+                        messages.append({
+                            "role": "assistant",
+                            "content": record['assistant']['content']
+                        })
+        return messages
+    
     async def get_models(self):
         """
         获取模型列表
@@ -125,13 +369,12 @@ class BaseService(ABC):
 
         Args:
             history: 历史消息列表，每条消息是一个字典，包含role和content字段
-            system_prompt: 系统提示词，如果提供则会覆盖当前的system_prompt
+            system_prompt: 系统提示词
 
         Returns:
             流式生成器，用于返回分块的回复内容
 
         Raises:
-            NotImplementedError: 子类必须实现此方法
             Exception: 聊天历史记录为空或未找到用户消息时抛出
         """
         if not history or len(history) == 0:
@@ -147,16 +390,12 @@ class BaseService(ABC):
         if user_message is None:
             raise Exception("未找到用户消息")
         
-        # 设置系统提示词
-        if system_prompt:
-            self.set_system_prompt(system_prompt)
-        
-        # 调用流式发送消息
-        return await self.send_message(user_message, stream=True) 
+        # 返回流式生成器
+        return self.stream_message(user_message, prompt=system_prompt)
     
     async def _process_image(self, image_path, host_url=None):
         """
-        处理图片，将本地路径转换为 base64 或处理远程 URL
+        处理图片，将本地路径缩放转码后转换为 base64 或处理远程 URL
 
         Args:
             image_path: 图片路径或 URL
@@ -165,42 +404,17 @@ class BaseService(ABC):
         Returns:
             处理后的图片数据（base64 或 URL）
         """
-        try:
-            # 检查是否是完整的外部 URL
-            parsed = urlparse(image_path)
-            if parsed.scheme in ('http', 'https') and not host_url:
-                return image_path
-
-            # 处理 ComfyUI API 或本地图片
-            async with aiohttp.ClientSession() as session:
-                if image_path.startswith('/api/view') and host_url:
-                    # 处理 ComfyUI API 格式的 URL
-                    base_path = image_path.split('&amp;rand=')[0]  # 移除随机参数
-
-                    # 将 URL 对象转换为字符串
-                    host_url_str = str(host_url)
-                    if host_url_str.endswith('/'):
-                        host_url_str = host_url_str[:-1]
-
-                    full_url = f"{host_url_str}{base_path}"
-
-                    # 获取图片内容
-                    async with session.get(full_url) as response:
-                        if response.status != 200:
-                            raise Exception(f"获取图片失败: HTTP {response.status}")
-                        image_data = await response.read()
-
-                        # 转换为 base64
-                        encoded_string = base64.b64encode(image_data).decode('utf-8')
-                        return f"data:image/jpeg;base64,{encoded_string}"
-
-                elif os.path.isfile(image_path):
-                    # 处理本地文件
-                    with open(image_path, 'rb') as image_file:
-                        encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                        return f"data:image/jpeg;base64,{encoded_string}"
-                else:
-                    raise Exception(f"无效的图片路径: {image_path}")
-
-        except Exception as e:
-            raise Exception(f"处理图片失败: {str(e)}")
\ No newline at end of file
+        return await image_ingestor.ingest_one(image_path, host_url, self.get_image_options())
+
+    async def _process_images(self, image_paths, host_url=None):
+        """
+        并发处理多张图片，结果顺序与输入一致
+
+        Args:
+            image_paths: 图片路径或 URL 列表
+            host_url: 主机 URL（用于处理相对路径）
+
+        Returns:
+            处理后的图片数据列表
+        """
+        return await image_ingestor.ingest(image_paths, host_url, self.get_image_options())
\ No newline at end of file
@@ -6,8 +6,14 @@ from .base import BaseService
 import g4f
 import os
 import json
+import time
 from pathlib import Path
-from ..config_api import load_config
+
+# g4f 中可以重试的错误（限流、所有提供方暂时失败），不同版本的 g4f 可能缺少其中一部分
+G4F_RETRYABLE_ERRORS = tuple(
+    error for error in (getattr(g4f.errors, name, None) for name in ("RateLimitError", "RetryProviderError"))
+    if error is not None
+)
 
 class G4FService(BaseService):
     """G4F服务类"""
@@ -85,14 +91,14 @@ class G4FService(BaseService):
         ]
         
 
+    # 缓存文件中的模型列表，首次使用时从磁盘读取
+    _cached_models = None
+    # 模型注册表：模型ID和显示名称 -> g4f 模型对象，随缓存的模型列表更新
+    _model_registry = None
+
     async def get_models(self):
         """获取 G4F 支持的模型列表"""
-        # 定义缓存文件路径
-        cache_dir = Path(os.path.dirname(os.path.abspath(__file__))) / "models_cache"
-        cache_file = cache_dir / "g4f_models.json"
-        cache_dir.mkdir(exist_ok=True)
-        
-        # 1. 首先尝试从网络获取最新模型列表
+        # 1. 首先尝试从 g4f 获取最新模型列表
         try:
             # 获取G4F支持的所有模型
             all_models = [name for name in dir(g4f.models) 
@@ -110,32 +116,18 @@ class G4FService(BaseService):
                         "model_path": f"g4f.models.{model_id}"
                     })
                 
-                #print(f"成功从网络获取到 {len(models)} 个G4F模型")
-                
-                # 更新缓存
-                try:
-                    with open(cache_file, 'w', encoding='utf-8') as f:
-                        json.dump(models, f, ensure_ascii=False, indent=2)
-                    #print("已更新模型缓存")
-                except Exception as e:
-                    print(f"更新模型缓存失败: {str(e)}")
-                
+                # 更新缓存（列表没有变化时不写文件）
+                self._save_models_cache(models)
                 return models
         except Exception as e:
             print(f"从网络获取模型列表失败: {str(e)}")
         
-        # 2. 如果网络获取失败，尝试从缓存读取
-        if cache_file.exists():
-            try:
-                with open(cache_file, 'r', encoding='utf-8') as f:
-                    cached_models = json.load(f)
-                    #print(f"使用缓存中的 {len(cached_models)} 个G4F模型")
-                    return cached_models
-            except Exception as e:
-                print(f"读取缓存失败: {str(e)}")
+        # 2. 如果获取失败，尝试从缓存读取
+        cached_models = self._load_models_cache()
+        if cached_models:
+            return cached_models
         
         # 3. 如果缓存也失败了，使用静态备份列表
-        #print("使用静态备份模型列表")
         backup_models = [
             {"id": "gpt_35_turbo", "name": "GPT-3.5-Turbo", "model_path": "g4f.models.gpt_35_turbo"},
             {"id": "gpt_4", "name": "GPT-4", "model_path": "g4f.models.gpt_4"},
@@ -145,147 +137,216 @@ class G4FService(BaseService):
         ]
         
         # 尝试将备份列表写入缓存
+        self._save_models_cache(backup_models)
+        return backup_models
+    
+    def _load_models_cache(self):
+        """读取缓存文件中的模型列表，只在首次调用时读取磁盘"""
+        if G4FService._cached_models is None:
+            models = []
+            if self.models_cache_file.exists():
+                try:
+                    with open(self.models_cache_file, 'r', encoding='utf-8') as f:
+                        models = json.load(f)
+                except Exception as e:
+                    print(f"读取缓存失败: {str(e)}")
+            G4FService._cached_models = models
+            G4FService._model_registry = None
+        return G4FService._cached_models
+    
+    def _save_models_cache(self, models):
+        """模型列表与缓存文件内容不同时写入缓存文件"""
+        if models == self._load_models_cache():
+            return
         try:
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                json.dump(backup_models, f, ensure_ascii=False, indent=2)
-            #print("已将备份模型列表写入缓存")
+            with open(self.models_cache_file, 'w', encoding='utf-8') as f:
+                json.dump(models, f, ensure_ascii=False, indent=2)
+            G4FService._cached_models = models
+            G4FService._model_registry = None
         except Exception as e:
-            print(f"写入备份模型列表到缓存失败: {str(e)}")
-        
-        return backup_models
-        
+            print(f"更新模型缓存失败: {str(e)}")
+    
+    def _get_model_registry(self):
+        """获取模型注册表，模型列表更新后首次调用时重建"""
+        if G4FService._model_registry is None:
+            registry = {}
+            for model in self._load_models_cache():
+                try:
+                    # 从model_path获取实际的模型对象
+                    model_obj = g4f
+                    for part in model["model_path"].split('.')[1:]:  # 跳过 'g4f'
+                        model_obj = getattr(model_obj, part)
+                except (AttributeError, KeyError):
+                    continue
+                registry.setdefault(model["id"], model_obj)
+                registry.setdefault(model["name"], model_obj)
+            G4FService._model_registry = registry
+        return G4FService._model_registry
         
-    async def send_message(self, message, stream=False, images=None, host_url=None, history=None, prompt=None):
-        """发送消息到 G4F"""
-        try:           
-            # 从配置文件加载参数
-            config = load_config("g4f")
-            
-            # 更新服务参数
-            if config:
-                self.set_temperature(config.get('temperature', self.temperature))
-                self.set_max_tokens(config.get('max_tokens', self.max_tokens))
-                self.set_timeout(config.get('timeout', self.timeout))
-                self.set_model(config.get('model', self.model))
-                self.set_proxy(config.get('proxy', self.proxy))
-            
-            # 设置代理
-            if self.proxy:
-                os.environ["http_proxy"] = self.proxy
-                os.environ["https_proxy"] = self.proxy
-            
-            # 构建消息
-            messages = []
-            if prompt:
-                messages.append({"role": "system", "content": prompt})
-            
-            # 处理历史记录
-            # history 格式: {'records': [{message_id, type, user: {content, images}, assistant: {content, images}}], 'has_more', 'next_id'}
-            if isinstance(history, dict) and 'records' in history:
-                # 按 message_id 排序，确保消息顺序正确
-                sorted_records = sorted(history['records'], key=lambda x: x['message_id'])
-                
-                for record in sorted_records:
-                    if record['type'] == 'message':
-                        # 添加用户消息
-                        if 'user' in record and 'content' in record['user']:
-                            messages.append({
-                                "role": "user",
-                                "content": record['user']['content']
-                            })
-                        
-                        # 添加助手回复
-                        if 'assistant' in record and 'content' in record['assistant']:
-                            messages.append({
-                                "role": "assistant",
-                                "content": record['assistant']['content']
-                            })
+    async def _build_request(self, message, images, host_url, history, prompt, options):
+        """
+        构建 g4f 请求参数
 
-            # 处理当前消息和图片
-            if images and len(images) > 0:
-                # 构建多模态消息
-                current_message = {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": message}
-                    ]
-                }
-                
-                # 添加图片
-                for image in images:
-                    image_url = await self._process_image(image, host_url)
-                    current_message["content"].append({
-                        "type": "image_url",
-                        "image_url": {"url": image_url}
-                    })
-            else:
-                # 纯文本消息
-                current_message = {"role": "user", "content": message}
-                
-            messages.append(current_message)
-            
-            # 映射模型名称
-            g4f_model = self._map_model_name(self.model)
+        Returns:
+            dict: 传给 g4f.ChatCompletion.create_async 的关键字参数（不含 stream）
+        """
+        # 构建消息（系统提示词 + 历史记录）
+        messages = self.build_messages(history, prompt)
 
-            # 准备请求数据
+        # 处理当前消息和图片
+        if images and len(images) > 0:
+            # 构建多模态消息
+            current_message = {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": message}
+                ]
+            }
             
-            parameters={
-                    "temperature": self.temperature,
-                    "max_tokens": self.max_tokens,
-                    "enable_search": True,
-                    "search_options": {
-                         "num_results": 5,
-                         "domain_whitelist": ["*.gov", "*.edu"],
-                         "time_range": "2020-01-01.."
-                         }
-                }
+            # 添加图片（并发获取和编码）
+            for image_url in await self._process_images(images, host_url):
+                current_message["content"].append({
+                    "type": "image_url",
+                    "image_url": {"url": image_url}
+                })
+        else:
+            # 纯文本消息
+            current_message = {"role": "user", "content": message}
             
+        messages.append(current_message)
+        
+        # 准备请求数据
+        parameters={
+                "temperature": options.temperature,
+                "max_tokens": options.max_tokens,
+                "enable_search": True,
+                "search_options": {
+                     "num_results": 5,
+                     "domain_whitelist": ["*.gov", "*.edu"],
+                     "time_range": "2020-01-01.."
+                     }
+            }
+        
+        return {
+            "model": self._map_model_name(options.model),
+            "messages": messages,
+            "temperature": options.temperature,
+            "max_tokens": options.max_tokens,
+            "timeout": options.timeout,
+            # 代理随请求传给 g4f 提供方，不修改进程环境变量，并发请求互不影响
+            "proxy": options.proxy or None,
+            "parameters": parameters
+        }
+        
+    async def send_message(self, message, stream=False, images=None, host_url=None, history=None, prompt=None, options=None):
+        """发送消息到 G4F（stream 为 True 时汇总流式结果后返回，逐段读取请使用 stream_message）"""
+        # 本次调用参数（不修改共享的服务实例）
+        options = options or self.get_call_options()
+        
+        if stream:
+            chunks = []
+            async for delta in self.stream_message(message, images=images, host_url=host_url,
+                                                   history=history, prompt=prompt, options=options):
+                chunks.append(delta)
+            return "".join(chunks)
+        
+        try:           
+            request = await self._build_request(message, images, host_url, history, prompt, options)
             
-            # 发送请求
-            response = await g4f.ChatCompletion.create_async(
-                model=g4f_model,
-                messages=messages,
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                timeout=self.timeout,
-                parameters=parameters
-            )
+            # 发送请求（限速，可重试的失败自动重试）
+            async def attempt(deadline):
+                return await g4f.ChatCompletion.create_async(**self._with_remaining_timeout(request, deadline))
+            
+            response = await self.call_upstream(attempt, options)
 
             return response
         except Exception as e:
             import traceback
             traceback.print_exc()
-            raise Exception(f"G4F 服务错误: {str(e)}")        
+            raise Exception(f"G4F 服务错误: {str(e)}")
+        
+    async def stream_message(self, message, images=None, host_url=None, history=None, prompt=None, options=None):
+        """
+        流式发送消息到 G4F，逐段产出增量文本
+
+        使用 g4f 的流式接口；提供方不支持流式时 g4f 会返回完整结果，此时一次性产出。
+
+        Yields:
+            str: 增量文本
+        """
+        # 本次调用参数（不修改共享的服务实例）
+        options = options or self.get_call_options()
+        
+        async def open_stream(deadline):
+            """发起流式请求并读取第一段，只在开始输出之前重试"""
+            result = g4f.ChatCompletion.create_async(
+                stream=True, ignore_stream=True, **self._with_remaining_timeout(request, deadline)
+            )
+            # 不支持流式的提供方返回协程
+            if not hasattr(result, "__aiter__"):
+                return None, await result
+            try:
+                return result, await result.__anext__()
+            except StopAsyncIteration:
+                return result, None
+            except BaseException:
+                await self._close_stream(result)
+                raise
+        
+        try:
+            request = await self._build_request(message, images, host_url, history, prompt, options)
+            result, first = await self.call_upstream(open_stream, options)
+        except Exception as e:
+            raise Exception(f"G4F 服务错误: {str(e)}")
+        
+        if result is None:
+            if first:
+                yield str(first)
+            return
+        
+        try:
+            if isinstance(first, str) and first:
+                yield first
+            async for chunk in result:
+                # 只转发文本片段，忽略用量统计、结束原因等对象
+                if isinstance(chunk, str) and chunk:
+                    yield chunk
+        except Exception as e:
+            raise Exception(f"G4F 服务错误: {str(e)}")
+        finally:
+            # 提前停止迭代时关闭上游生成器，释放连接
+            await self._close_stream(result)
+    
+    @staticmethod
+    async def _close_stream(result):
+        """关闭 g4f 返回的异步生成器"""
+        aclose = getattr(result, "aclose", None)
+        if aclose is not None:
+            await aclose()
+    
+    @staticmethod
+    def _with_remaining_timeout(request, deadline):
+        """将请求的超时时间设置为距总截止时间的剩余秒数"""
+        return dict(request, timeout=max(int(deadline - time.monotonic()), 1))
+    
+    def is_retryable_error(self, error):
+        """判断错误是否可以重试：通用规则加上 g4f 的限流和提供方暂时失败"""
+        return super().is_retryable_error(error) or isinstance(error, G4F_RETRYABLE_ERRORS)
+
     def _map_model_name(self, model_name):
         """
         将模型名称映射到 G4F 支持的模型
         
         Args:
-            model_name: 用户选择的模型名称
+            model_name: 用户选择的模型名称（模型ID或显示名称）
             
         Returns:
             G4F 支持的模型对象
         """
-        try:
-            # 读取缓存的模型列表
-            cache_file = Path(os.path.dirname(os.path.abspath(__file__))) / "models_cache" / "g4f_models.json"
-            if cache_file.exists():
-                with open(cache_file, 'r', encoding='utf-8') as f:
-                    models = json.load(f)
-                    # 查找匹配的模型
-                    for model in models:
-                        if model["id"] == model_name or model["name"] == model_name:
-                            # 从model_path获取实际的模型对象
-                            model_parts = model["model_path"].split('.')
-                            model_obj = g4f
-                            for part in model_parts[1:]:  # 跳过 'g4f'
-                                model_obj = getattr(model_obj, part)
-                            return model_obj
-            
-            # 如果没有找到匹配的模型，返回默认模型
-            print(f"未找到匹配的模型 '{model_name}'，使用默认模型 gpt-3.5-turbo")
-            return g4f.models.gpt_35_turbo
-            
-        except Exception as e:
-            print(f"模型映射失败: {str(e)}，使用默认模型 gpt-3.5-turbo")
-            return g4f.models.gpt_35_turbo
+        model_obj = self._get_model_registry().get(model_name)
+        if model_obj is not None:
+            return model_obj
+        
+        # 如果没有找到匹配的模型，返回默认模型
+        print(f"未找到匹配的模型 '{model_name}'，使用默认模型 gpt-3.5-turbo")
+        return getattr(g4f.models, 'gpt_35_turbo', None) or g4f.models.default
@@ -1,13 +1,29 @@
 """千问服务实现"""
 import json
+import time
 import aiohttp
 from urllib.parse import urlparse
 from .base import BaseService
-from ..config_api import load_config
+from ..utils.sse import iter_sse_events
+from ..utils.resilience import UpstreamHTTPError, parse_retry_after
 
 class QianwenService(BaseService):
     """千问服务类"""
 
+    # 模型名称映射（类级常量，所有实例共享）
+    model_mapping_text = {
+        "通义千问 Max": "qwen-max",
+        "通义千问 Plus": "qwen-plus",
+        "通义千问 Turbo": "qwen-turbo",
+        "通义千问 Long": "qwen-long",
+    }
+    model_mapping_vision = {
+        "通义千问 VL Plus": "qwen-vl-plus",
+        "通义千问 VL Max": "qwen-vl-max",
+        "通义千问 VL Max Latest": "qwen-vl-max-latest",
+        "通义千问 VL OCR": "qwen-vl-ocr"
+    }
+
     def __init__(self):
         """初始化默认参数"""
         super().__init__()  # 先调用基类初始化
@@ -15,19 +31,6 @@ class QianwenService(BaseService):
         self.api_endpoint = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
         self.api_endpoint_image = "https://dashscope.aliyuncs.com/api/v1/services/aigc/image-generation/generation"
         self.vision_api_endpoint = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
-        # 模型名称映射
-        self.model_mapping_text  = {
-            "通义千问 Max": "qwen-max",
-            "通义千问 Plus": "qwen-plus",
-            "通义千问 Turbo": "qwen-turbo",
-            "通义千问 Long": "qwen-long",
-        }
-        self.model_mapping_vision = {
-            "通义千问 VL Plus": "qwen-vl-plus",
-            "通义千问 VL Max": "qwen-vl-max",
-            "通义千问 VL Max Latest": "qwen-vl-max-latest",
-            "通义千问 VL OCR": "qwen-vl-ocr"
-        }
         # 其他参数使用基类默认值:
         self.temperature = 1
         self.max_tokens = 2000
@@ -55,140 +58,149 @@ class QianwenService(BaseService):
         ]
 
 
-    async def send_image(self, message,stream=False, images=None, host_url=None, history=None, prompt=None):
+    def _build_text_request(self, message, history, prompt, options, stream=False):
         """
-        发送图片请求到通义千问视觉模型
-
-        Args:
-            image_url: 图片URL或Base64编码
-            prompt: 提示文本
-            task: 任务类型 (如 "ocr", "image_captioning")
-            stream: 是否使用流式输出（视觉模型可能不支持）
+        构建文本生成请求
 
         Returns:
-            模型的文本响应
+            (headers, data) 元组
         """
-        try:
-            # 从配置文件加载参数
-            config = load_config("qianwen")
-
-            # 更新服务参数
-            if config:
-                self.set_temperature(config.get('temperature', self.temperature))
-                self.set_max_tokens(config.get('max_tokens', self.max_tokens))
-                self.set_timeout(config.get('timeout', self.timeout))
-                self.set_model(config.get('model', self.model))
-                self.set_proxy(config.get('proxy', self.proxy))
-                self.set_api_key(config.get('api_key', self.api_key))
-
-            if not self.api_key:
-                raise Exception("请设置API密钥")
+        # 构建消息数组，包含历史记录和当前消息
+        messages = self.build_messages(history, prompt)
+        messages.append({
+            "role": "user",
+            "content": message
+        })
+
+        # 准备请求头
+        headers = {
+            "Authorization": f"Bearer {options.api_key}",
+            "Content-Type": "application/json"
+        }
 
-            # 准备请求头
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
+        model = options.model
+        if model not in self.model_mapping_text.values():
+            model = self.model_mapping_text["通义千问 Max"]
+
+        # 准备请求数据
+        data = {
+            "model": model,
+            "input": {
+                "messages": messages
+            },
+            "parameters": {
+                "temperature": options.temperature,
+                "max_tokens": options.max_tokens,
+                "enable_search": True
             }
+        }
 
-            if self.model not in self.model_mapping_vision:
-                self.model = self.model_mapping_vision["通义千问 VL Plus"]
-
-            messages = []
-
-            if prompt:
-                messages.append({"role": "system", "content": prompt})
-
-            if isinstance(history, dict) and 'records' in history:
-                # 按 message_id 排序，确保消息顺序正确
-                sorted_records = sorted(history['records'], key=lambda x: x['message_id'])
-                
-                for record in sorted_records:
-                    if record['type'] == 'message':
-                        # 添加用户消息
-                        if 'user' in record and 'content' in record['user']:
-                            messages.append({
-                                "role": "user",
-                                "content": record['user']['content']
-                            })
-                        
-                        # 添加助手回复
-                        if 'assistant' in record and 'content' in record['assistant']:
-                            messages.append({
-                                "role": "assistant",
-                                "content": record['assistant']['content']
-                            })
-            
-            
-            # 初始化计数器
-            i = 0  # 必须添加的初始化
-            image_content = []  # PEP8空格规范
-
-            # 处理图片URL
-            for image in images:
-                image_url = await self._process_image(image, host_url)
-                i += 1  # 更规范的写法
-                if i <= 5:  # 限制最多5张图（i=1到5）
-                    image_content.append({
-                        "type": "image_url",
-                        "image_url": {"url": image_url}
-                    })
-                else:
-                    break  # 超过5张时停止处理
-            if prompt:
-                content_list.append({"type": "text", "text": prompt})
-            # 构建消息内容（展开列表）
-            content_list = [{"type": "text", "text": message}]  # 文本部分
-
-                
-            content_list.extend(image_content)  # 关键修正：展开图片内容
-
-            messages.append({
-                                    "role": "user",
-                                    "content": content_list
-                                })
-
-            data = {
-                "model": self.model,
-                "messages": messages,
-                 "parameters": {
-                    "temperature": self.temperature,
-                    "max_tokens": self.max_tokens,
-                    "enable_search": True
-                }
+        # 设置流式模式，每个事件只返回新增的文本
+        if stream:
+            headers["X-DashScope-SSE"] = "enable"
+            data["parameters"]["incremental_output"] = True
+
+        return headers, data
+
+    async def _build_vision_request(self, message, images, host_url, history, prompt, options, stream=False):
+        """
+        构建视觉模型请求（OpenAI 兼容模式）
+
+        Returns:
+            (headers, data) 元组
+        """
+        # 准备请求头
+        headers = {
+            "Authorization": f"Bearer {options.api_key}",
+            "Content-Type": "application/json"
+        }
+
+        model = options.model
+        if model not in self.model_mapping_vision.values():
+            model = self.model_mapping_vision["通义千问 VL Plus"]
+
+        messages = self.build_messages(history, prompt)
+
+        # 处理图片URL，最多5张（并发获取和编码）
+        image_content = []
+        for image_url in await self._process_images(images[:5], host_url):
+            image_content.append({
+                "type": "image_url",
+                "image_url": {"url": image_url}
+            })
+
+        # 构建消息内容（文本 + 图片）
+        content_list = [{"type": "text", "text": message}]
+        content_list.extend(image_content)
+
+        messages.append({
+            "role": "user",
+            "content": content_list
+        })
+
+        data = {
+            "model": model,
+            "messages": messages,
+            "parameters": {
+                "temperature": options.temperature,
+                "max_tokens": options.max_tokens,
+                "enable_search": True
             }
+        }
 
+        if stream:
+            data["stream"] = True
 
-            # 设置超时
-            timeout = aiohttp.ClientTimeout(total=self.timeout)
+        return headers, data
 
-            
+    async def send_image(self, message,stream=False, images=None, host_url=None, history=None, prompt=None, options=None):
+        """
+        发送图片请求到通义千问视觉模型
 
-            # 发送请求
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.vision_api_endpoint,
-                    headers=headers,
-                    json=data,
-                    proxy=self.proxy if self.proxy else None,
-                    timeout=timeout
-                ) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        raise Exception(f"视觉API错误 ({response.status}): {error_text}")
+        Args:
+            message: 消息内容
+            stream: 是否使用流式输出（为 True 时汇总流式结果后返回）
+            images: 图片列表
+            host_url: 主机URL（用于处理相对路径的图片）
+            history: 对话历史记录
+            prompt: 系统提示词
+            options: 本次调用参数
 
-                    result = await response.json()
-                    
-                    # 解析返回数据
-                    if "choices" in result and len(result["choices"]) > 0:
-                        message = result["choices"][0].get("message", {})
-                        if "content" in message:
-                            return message["content"]
-                        elif "output" in result and "text" in result["output"]:
-                            return result["output"]["text"]
-                        else:
-                            raise Exception("API返回数据缺少content字段")
+        Returns:
+            模型的文本响应
+        """
+        # 本次调用参数（不修改共享的服务实例）
+        options = options or self.get_call_options()
+
+        if stream:
+            chunks = []
+            async for delta in self.stream_message(message, images=images, host_url=host_url,
+                                                   history=history, prompt=prompt, options=options):
+                chunks.append(delta)
+            return "".join(chunks)
+
+        try:
+            if not options.api_key:
+                raise Exception("请设置API密钥")
+
+            headers, data = await self._build_vision_request(message, images, host_url, history, prompt, options)
+
+            # 发送请求（限速，可重试的失败自动重试）
+            response = await self._post(self.vision_api_endpoint, headers, data, options, "视觉API错误")
+            async with response:
+                result = await response.json()
+
+                # 解析返回数据
+                if "choices" in result and len(result["choices"]) > 0:
+                    message = result["choices"][0].get("message", {})
+                    if "content" in message:
+                        return message["content"]
+                    elif "output" in result and "text" in result["output"]:
+                        return result["output"]["text"]
                     else:
-                        raise Exception(f"视觉API返回格式错误: {json.dumps(result)}")
+                        raise Exception("API返回数据缺少content字段")
+                else:
+                    raise Exception(f"视觉API返回格式错误: {json.dumps(result)}")
 
         except aiohttp.ClientError as e:
             raise Exception(f"视觉请求失败: {str(e)}")
@@ -198,120 +210,37 @@ class QianwenService(BaseService):
             raise Exception(f"视觉服务错误: {str(e)}")
     
     
-    async def send_message(self, message, stream=False, images=None, host_url=None, history=None, prompt=None):
-        """发送消息"""
-        try:
-            # 从配置文件加载参数
-            config = load_config("qianwen")
-
-            # 更新服务参数
-            if config:
-                self.set_temperature(config.get('temperature', self.temperature))
-                self.set_max_tokens(config.get('max_tokens', self.max_tokens))
-                self.set_timeout(config.get('timeout', self.timeout))
-                self.set_model(config.get('model', self.model))
-                self.set_proxy(config.get('proxy', self.proxy))
-                self.set_api_key(config.get('api_key', self.api_key))
-
-            if not self.api_key:
-                raise Exception("请设置API密钥")
+    async def send_message(self, message, stream=False, images=None, host_url=None, history=None, prompt=None, options=None):
+        """发送消息（stream 为 True 时汇总流式结果后返回，逐段读取请使用 stream_message）"""
+        # 本次调用参数（不修改共享的服务实例）
+        options = options or self.get_call_options()
 
-            # 如果有图片，使用视觉API
-            if images and len(images) > 0:
+        # 如果有图片，使用视觉API
+        if images and len(images) > 0:
+            return await self.send_image(message=message,stream=stream,images=images, host_url=host_url, history=history,prompt=prompt,options=options)
 
-                # 调用视觉API
-                return await self.send_image(message=message,stream=stream,images=images, host_url=host_url, history=history,prompt=prompt)
-
-            # 构建消息数组，包含历史记录
-            messages = []
-
-            if prompt:
-                messages.append({"role": "system", "content": prompt})
-
-            # 如果提供了历史记录，将其添加到消息列表中
-            if isinstance(history, dict) and 'records' in history:
-                # 按 message_id 排序，确保消息顺序正确
-                sorted_records = sorted(history['records'], key=lambda x: x['message_id'])
-                
-                for record in sorted_records:
-                    if record['type'] == 'message':
-                        # 添加用户消息
-                        if 'user' in record and 'content' in record['user']:
-                            messages.append({
-                                "role": "user",
-                                "content": record['user']['content']
-                            })
-                        
-                        # 添加助手回复
-                        if 'assistant' in record and 'content' in record['assistant']:
-                            messages.append({
-                                "role": "assistant",
-                                "content": record['assistant']['content']
-                            })
-
-            # 添加当前消息
-            messages.append({
-                "role": "user",
-                "content": message
-            })
-
-            # 准备请求头
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            if self.model not in self.model_mapping_text:
-                self.model = self.model_mapping_text["通义千问 Max"]
-
-
-
-            # 准备请求数据
-            data = {
-                "model": self.model,
-                "input": {
-                    "messages": messages
-                },
-                "parameters": {
-                    "temperature": self.temperature,
-                    "max_tokens": self.max_tokens,
-                    "enable_search": True
-                }
-            }
+        if stream:
+            chunks = []
+            async for delta in self.stream_message(message, history=history, prompt=prompt, options=options):
+                chunks.append(delta)
+            return "".join(chunks)
 
-            # 设置流式模式
-            if stream:
-                headers["X-DashScope-SSE"] = "enable"
+        try:
+            if not options.api_key:
+                raise Exception("请设置API密钥")
 
-            
+            headers, data = self._build_text_request(message, history, prompt, options)
 
-            # 使用 aiohttp 发送请求
+            # 使用 aiohttp 发送请求（限速，可重试的失败自动重试）
             try:
-                timeout = aiohttp.ClientTimeout(total=self.timeout)
-
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        self.api_endpoint,
-                        headers=headers,
-                        json=data,
-                        proxy=self.proxy if self.proxy else None,
-                        timeout=timeout
-                    ) as response:
-                        if response.status != 200:
-                            error_text = await response.text()
-                            raise Exception(f"千问 API 错误 ({response.status}): {error_text}")
-
-                        # 处理流式响应
-                        if stream:
-                            return response  # 返回响应对象，由调用方处理流
-                        else:
-                            # 处理常规响应
-                            result = await response.json()
-
-                            if "output" in result and "text" in result["output"]:
-                                return result["output"]["text"]
-                            else:
-                                raise Exception(f"千问 API 返回格式错误: {json.dumps(result)}")
+                response = await self._post(self.api_endpoint, headers, data, options, "千问 API 错误")
+                async with response:
+                    result = await response.json()
+
+                    if "output" in result and "text" in result["output"]:
+                        return result["output"]["text"]
+                    else:
+                        raise Exception(f"千问 API 返回格式错误: {json.dumps(result)}")
 
             except aiohttp.ClientError as e:
                 raise Exception(f"请求失败: {str(e)}")
@@ -320,32 +249,110 @@ class QianwenService(BaseService):
                 traceback.print_exc()
                 raise Exception(f"千问服务错误: {str(e)}")
 
-    async def stream_chat(self, history=None, system_prompt=None):
+    async def stream_message(self, message, images=None, host_url=None, history=None, prompt=None, options=None):
         """
-        流式对话
+        流式发送消息，逐段产出增量文本
 
-        Args:
-            history: 历史消息
-            system_prompt: 系统提示词
+        文本模型使用 DashScope SSE（incremental_output），视觉模型使用 OpenAI 兼容模式的流式输出。
+        连接在生成器内部打开和关闭，调用方停止迭代或取消时连接随之释放。
 
-        Returns:
-            流式生成器
+        Yields:
+            str: 增量文本
         """
-        if not history or len(history) == 0:
-            raise Exception("聊天历史记录不能为空")
+        # 本次调用参数（不修改共享的服务实例）
+        options = options or self.get_call_options()
+
+        if not options.api_key:
+            raise Exception("千问服务错误: 请设置API密钥")
+
+        try:
+            if images and len(images) > 0:
+                endpoint = self.vision_api_endpoint
+                headers, data = await self._build_vision_request(
+                    message, images, host_url, history, prompt, options, stream=True
+                )
+            else:
+                endpoint = self.api_endpoint
+                headers, data = self._build_text_request(message, history, prompt, options, stream=True)
+        except Exception as e:
+            raise Exception(f"千问服务错误: {str(e)}")
 
-        # 获取最后一条用户消息
-        user_message = None
-        for msg in reversed(history):
-            if msg["role"] == "user":
-                user_message = msg["content"]
-                break
+        try:
+            # 只在开始接收内容之前重试，已输出的内容不会重复
+            response = await self._post(endpoint, headers, data, options, "千问 API 错误")
+            async with response:
+                async for event, event_data in iter_sse_events(response):
+                    if event_data == "[DONE]":
+                        break
+                    try:
+                        result = json.loads(event_data)
+                    except json.JSONDecodeError:
+                        continue
+
+                    if event == "error" or result.get("code"):
+                        raise Exception(f"千问 API 错误: {result.get('message') or event_data}")
+
+                    delta = self._parse_stream_delta(result)
+                    if delta:
+                        yield delta
+        except aiohttp.ClientError as e:
+            raise Exception(f"千问服务错误: 请求失败: {str(e)}")
+
+    async def _post(self, endpoint, headers, data, options, error_label):
+        """
+        发送 POST 请求，每次尝试前按 API 密钥限速，429、5xx 和连接错误在超时时间内退避重试
 
-        if user_message is None:
-            raise Exception("未找到用户消息")
+        Args:
+            endpoint: 请求地址
+            headers: 请求头
+            data: 请求体
+            options: 本次调用参数
+            error_label: 错误信息前缀
 
-        # 调用流式发送消息
-        return await self.send_message(user_message, stream=True)
+        Returns:
+            状态码为 200 的响应，调用方使用 async with 读取并释放
+        """
+        session = self.get_http_session(options.proxy)
+
+        async def attempt(deadline):
+            # 每次尝试只使用剩余的时间
+            timeout = aiohttp.ClientTimeout(total=max(deadline - time.monotonic(), 0.001))
+            response = await session.post(
+                endpoint,
+                headers=headers,
+                json=data,
+                proxy=options.proxy if options.proxy else None,
+                timeout=timeout
+            )
+            if response.status != 200:
+                try:
+                    error_text = await response.text()
+                finally:
+                    response.release()
+                raise UpstreamHTTPError(
+                    response.status,
+                    f"{error_label} ({response.status}): {error_text}",
+                    parse_retry_after(response.headers.get("Retry-After"))
+                )
+            return response
+
+        return await self.call_upstream(attempt, options)
+
+    @staticmethod
+    def _parse_stream_delta(result):
+        """从流式事件中取出增量文本，兼容 DashScope 和 OpenAI 兼容模式两种格式"""
+        if "output" in result:
+            output = result["output"]
+            if output.get("text"):
+                return output["text"]
+            choices = output.get("choices") or []
+            if choices:
+                return (choices[0].get("message") or {}).get("content") or ""
+            return ""
+        choices = result.get("choices") or []
+        if choices:
+            return (choices[0].get("delta") or {}).get("content") or ""
+        return ""
 
     def set_temperature(self, temperature):
         """设置温度"""
@@ -361,15 +368,19 @@ class QianwenService(BaseService):
 
     def set_model(self, model):
         """设置模型"""
+        self.model = self.normalize_model(model)
+
+    def normalize_model(self, model):
+        """将模型显示名称映射为模型ID"""
         # 检查是否在文本模型映射中
         if model in self.model_mapping_text:
-            self.model = self.model_mapping_text[model]
+            return self.model_mapping_text[model]
         # 检查是否在视觉模型映射中
         elif model in self.model_mapping_vision:
-            self.model = self.model_mapping_vision[model]
+            return self.model_mapping_vision[model]
         else:
             # 如果找不到映射，使用原始值
-            self.model = model
+            return model
 
     def set_proxy(self, proxy):
         """设置代理"""
@@ -4,13 +4,18 @@
 """
 
 from aiohttp import web
+import copy
 import json
 import os
+import threading
+import time
 from pathlib import Path
-from typing import  Dict, Any
+from typing import  Dict, Any, Callable, Optional
 import traceback
 import base64
 
+from .utils.handler_loader import load_handler_function, handler_registry
+
 
 # 默认提示词
 DEFAULT_PROMPTS = {
@@ -27,6 +32,128 @@ DEFAULT_PROMPTS = {
 PROMPTS_DIR = Path(os.path.dirname(os.path.abspath(__file__))) / "prompts"
 PROMPTS_FILE = PROMPTS_DIR / "prompts.json"
 
+# 检查提示词文件是否被外部修改的最小间隔（秒）
+PROMPTS_CHECK_INTERVAL = 2.0
+
+class PromptCatalog:
+    """
+    提示词目录
+    
+    在内存中缓存 prompts.json（按 prompt_id 建立索引）、按需读取的 .ini 提示词内容
+    以及提示词处理函数。set_prompt / delete_prompt 保存后立即失效，
+    外部修改通过文件修改时间和大小检测，检测间隔为 check_interval 秒
+    """
+    
+    def __init__(self, prompts_file: Path, prompts_dir: Path, check_interval: float = PROMPTS_CHECK_INTERVAL):
+        self.prompts_file = prompts_file
+        self.prompts_dir = prompts_dir
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        self._data: Optional[Dict[str, Any]] = None
+        self._index: Dict[str, Dict[str, Any]] = {}
+        self._stat = None
+        self._checked_at = 0.0
+        # prompt_content_path -> {"content": 内容, "stat": 文件状态, "checked_at": 检查时间}
+        self._contents: Dict[str, Dict[str, Any]] = {}
+        # (prompt_id, 处理函数类型) -> 处理函数
+        self._handlers: Dict[tuple, Optional[Callable]] = {}
+    
+    @staticmethod
+    def _file_stat(file_path: Path):
+        """获取文件的 (修改时间, 大小)，文件不存在时返回 None"""
+        try:
+            stat = os.stat(file_path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+    
+    def get_all(self) -> Dict[str, Any]:
+        """获取全部提示词数据（共享对象，调用方不要修改）"""
+        self._refresh()
+        return self._data
+    
+    def get(self, prompt_id: str) -> Dict[str, Any]:
+        """获取提示词配置（共享对象，调用方不要修改），未找到时返回空字典"""
+        self._refresh()
+        return self._index.get(prompt_id, {})
+    
+    def get_content(self, prompt_id: str) -> str:
+        """获取提示词内容（.ini 文件），首次使用时读取，文件变化后重新读取"""
+        content_path = self.get(prompt_id).get("prompt_content_path")
+        if not content_path:
+            return ""
+        
+        now = time.monotonic()
+        entry = self._contents.get(content_path)
+        if entry is not None and now - entry["checked_at"] < self.check_interval:
+            return entry["content"]
+        
+        with self._lock:
+            content_file = self.prompts_dir / content_path
+            stat = self._file_stat(content_file)
+            if entry is None or entry["stat"] != stat:
+                content = ""
+                if stat is not None:
+                    with open(content_file, "r", encoding="utf-8") as f:
+                        content = f.read()
+                entry = {"content": content, "stat": stat}
+            entry["checked_at"] = now
+            self._contents[content_path] = entry
+            return entry["content"]
+    
+    def get_handler(self, prompt_id: str, handler_type: str) -> Optional[Callable]:
+        """
+        获取提示词配置的处理函数
+        
+        Args:
+            prompt_id: 提示词ID
+            handler_type: 处理函数类型，'prompt_fun'（处理回复）或 'prompt_run'（生成提示词附加内容）
+            
+        Returns:
+            处理函数，未配置或加载失败时返回 None
+        """
+        prompt_data = self.get(prompt_id)
+        function_name = prompt_data.get(handler_type)
+        module_path = prompt_data.get(f"{handler_type}_path")
+        if not function_name or not module_path:
+            return None
+        
+        # 热重载模式下每次都交给注册表检查文件变化
+        if handler_registry.hot_reload:
+            return load_handler_function(module_path, function_name)
+        
+        key = (prompt_id, handler_type)
+        if key not in self._handlers:
+            handler = load_handler_function(module_path, function_name)
+            if handler is None:
+                return None
+            self._handlers[key] = handler
+        return self._handlers[key]
+    
+    def invalidate(self) -> None:
+        """使缓存失效，下次使用时重新读取"""
+        with self._lock:
+            self._data = None
+            self._index = {}
+            self._contents.clear()
+            self._handlers.clear()
+    
+    def _refresh(self) -> None:
+        """未加载或提示词文件变化时重新读取"""
+        now = time.monotonic()
+        if self._data is not None and now - self._checked_at < self.check_interval:
+            return
+        
+        with self._lock:
+            stat = self._file_stat(self.prompts_file)
+            if self._data is None or stat != self._stat:
+                data = read_prompts_file()
+                self._index = {p.get("prompt_id"): p for p in data.get("prompts", [])}
+                self._data = data
+                self._stat = self._file_stat(self.prompts_file)
+                self._handlers.clear()
+            self._checked_at = now
+
 def register_prompt_api(app):
     """注册提示词相关的 API 路由"""
     try:
@@ -90,7 +217,11 @@ async def get_prompt(request):   # 获取指定id提示词，只返回提示词
         return web.json_response({'success': False,'error': str(e)}, status=500)
     
 def load_prompts() -> Dict[str, Any]:  # 加载提示词数据
-    """加载提示词数据"""
+    """加载提示词数据（副本，可修改后传给 save_prompts）"""
+    return copy.deepcopy(prompt_catalog.get_all())
+
+def read_prompts_file() -> Dict[str, Any]:
+    """从文件读取提示词数据"""
     # 确保提示词目录存在
     PROMPTS_DIR.mkdir(exist_ok=True, parents=True)
     
@@ -99,7 +230,7 @@ def load_prompts() -> Dict[str, Any]:  # 加载提示词数据
         # 保存默认配置到文件
         with open(PROMPTS_FILE, "w", encoding="utf-8") as f:
             json.dump(DEFAULT_PROMPTS, f, ensure_ascii=False, indent=4)
-        return DEFAULT_PROMPTS
+        return copy.deepcopy(DEFAULT_PROMPTS)
     
     # 读取并解析提示词文件
     try:
@@ -107,14 +238,14 @@ def load_prompts() -> Dict[str, Any]:  # 加载提示词数据
             prompts_data = json.load(f)
             # 验证数据结构
             if not isinstance(prompts_data, dict) or "prompts" not in prompts_data:
-                return DEFAULT_PROMPTS
+                return copy.deepcopy(DEFAULT_PROMPTS)
             return prompts_data
         
     except json.JSONDecodeError:
-        return DEFAULT_PROMPTS
+        return copy.deepcopy(DEFAULT_PROMPTS)
     except Exception as e:
         print(f"加载提示词数据失败: {str(e)}")
-        return DEFAULT_PROMPTS
+        return copy.deepcopy(DEFAULT_PROMPTS)
 
 def load_prompt(prompt_id: str) -> str:  # 加载指定id的提示词内容
     """
@@ -127,33 +258,7 @@ def load_prompt(prompt_id: str) -> str:  # 加载指定id的提示词内容
         str: 提示词内容
     """
     try:
-        # 获取提示词配置
-        prompts_data = load_prompts()
-        
-        # 查找提示词配置
-        prompt_config = None
-        for p in prompts_data["prompts"]:
-            if p["prompt_id"] == prompt_id:
-                prompt_config = p
-                break
-                
-        if not prompt_config:
-            return ""
-            
-        # 读取提示词内容文件
-        content_path = prompt_config.get("prompt_content_path")
-        if not content_path:
-            return ""
-            
-        content_file = PROMPTS_DIR / content_path
-        if not content_file.exists():
-            return ""
-            
-        # 读取内容
-        with open(content_file, "r", encoding="utf-8") as f:
-            content = f.read()
-            
-        return content
+        return prompt_catalog.get_content(prompt_id)
         
     except Exception as e:
         print(f"加载提示词内容失败: {str(e)}")
@@ -173,6 +278,8 @@ def save_prompts(prompts_data: Dict[str, Any]) -> bool:  # 保存提示词数据
     except Exception as e:
         print(f"保存提示词失败: {str(e)}")
         return False
+    finally:
+        prompt_catalog.invalidate()
 
 def save_prompt(prompt_id: str, prompt_name: str, prompt_content_path: str, prompt_content: str) -> bool:
     """
@@ -216,6 +323,8 @@ def save_prompt(prompt_id: str, prompt_name: str, prompt_content_path: str, prom
     except Exception as e:
         print(f"保存提示词内容失败: {str(e)}")
         return False
+    finally:
+        prompt_catalog.invalidate()
     
     return save_prompts(prompts_data)
 
@@ -271,6 +380,7 @@ async def delete_prompt(request): # prompt_id 为all时，删除所有提示词
                     import shutil
                     shutil.rmtree(PROMPTS_DIR)
                 PROMPTS_DIR.mkdir(exist_ok=True, parents=True)
+                prompt_catalog.invalidate()
                 
                 # 重新创建默认提示词配置
                 save_prompt(DEFAULT_PROMPTS.get("prompt_id"), DEFAULT_PROMPTS.get("prompt_name"), 
@@ -296,6 +406,7 @@ async def delete_prompt(request): # prompt_id 为all时，删除所有提示词
                     content_file = PROMPTS_DIR / content_path
                     if content_file.exists():
                         content_file.unlink()
+                        prompt_catalog.invalidate()
                 
                 # 从配置中删除提示词
                 prompts_data["prompts"].pop(i)
@@ -327,21 +438,32 @@ def load_prompt_data(prompt_id: str) -> dict:  # 加载指定id的提示词内
         prompt_id: 提示词ID
         
     Returns:
-        dict: 提示词配置字典，如果未找到则返回空字典
+        dict: 提示词配置字典（共享对象，调用方不要修改），如果未找到则返回空字典
     """
     try:
-        # 获取提示词配置
-        prompts_data = load_prompts()
+        return prompt_catalog.get(prompt_id)
         
-        # 查找提示词配置
-        for prompt in prompts_data["prompts"]:
-            if prompt["prompt_id"] == prompt_id:
-                # 如果找到匹配的提示词ID，直接返回该提示词配置
-                return prompt
-                
-        # 如果未找到匹配的提示词ID，返回空字典
+    except Exception as e:
+        print(f"加载提示词数据失败: {str(e)}")
         return {}
+
+def load_prompt_handler(prompt_id: str, handler_type: str) -> Optional[Callable]:
+    """
+    获取提示词配置的处理函数
+    
+    Args:
+        prompt_id: 提示词ID
+        handler_type: 'prompt_fun'（处理回复）或 'prompt_run'（生成提示词附加内容）
+        
+    Returns:
+        处理函数，未配置或加载失败时返回 None
+    """
+    try:
+        return prompt_catalog.get_handler(prompt_id, handler_type)
         
     except Exception as e:
-        print(f"加载提示词数据失败: {str(e)}")
-        return {}
\ No newline at end of file
+        print(f"加载提示词处理函数失败: {str(e)}")
+        return None
+
+# 全局提示词目录
+prompt_catalog = PromptCatalog(PROMPTS_FILE, PROMPTS_DIR)
@@ -2,7 +2,8 @@
 服务相关的 API 端点
 """
 from aiohttp import web
-from ai_services import get_service, get_all_services
+from ai_services import get_service_instance, get_all_services
+from .utils.model_cache import model_list_cache
 
 def register_service_api(app):
     """注册服务相关的API路由"""
@@ -15,14 +16,13 @@ async def get_models(request):
         # 获取服务ID
         service_id = request.query.get("service", "g4f")  # 默认使用g4f服务
         
-        # 获取服务实例
-        service_class = get_service(service_id)
-        if not service_class:
+        # 获取共享的服务实例
+        service = get_service_instance(service_id)
+        if not service:
             return web.json_response({"success": False, "error": "服务不存在"})
             
-        # 创建服务实例并获取模型列表
-        service = service_class()
-        models = await service.get_models()
+        # 获取模型列表（按服务缓存，并发请求共享同一次获取）
+        models = await model_list_cache.get(service_id, service.get_models)
         
         # 直接返回模型列表
         return web.json_response({"success": True, "models": models})
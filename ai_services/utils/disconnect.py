@@ -0,0 +1,95 @@
+# ai_services/utils/disconnect.py
+"""
+客户端断开检测
+在等待上游服务时检测浏览器是否已断开连接，断开后取消上游请求，及时释放连接和工作资源
+"""
+import asyncio
+import contextlib
+from typing import AsyncIterator, Awaitable, TypeVar
+
+T = TypeVar('T')
+
+# 检查客户端连接状态的间隔（秒）
+DISCONNECT_POLL_INTERVAL = 0.5
+
+
+class ClientDisconnectedError(ConnectionResetError):
+    """客户端已断开连接"""
+
+
+def is_client_disconnected(request) -> bool:
+    """
+    判断请求的客户端是否已断开连接
+
+    Args:
+        request: aiohttp.web.Request 对象
+
+    Returns:
+        连接已关闭或正在关闭时返回 True
+    """
+    transport = request.transport
+    return transport is None or transport.is_closing()
+
+
+async def run_until_disconnected(request, awaitable: Awaitable[T],
+                                 poll_interval: float = DISCONNECT_POLL_INTERVAL) -> T:
+    """
+    等待 awaitable 完成，期间客户端断开时取消它
+
+    Args:
+        request: aiohttp.web.Request 对象
+        awaitable: 上游请求
+        poll_interval: 检查客户端连接状态的间隔（秒）
+
+    Returns:
+        awaitable 的结果
+
+    Raises:
+        ClientDisconnectedError: 客户端在完成前断开连接
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if is_client_disconnected(request):
+                task.cancel()
+                await asyncio.wait({task})
+                raise ClientDisconnectedError("客户端已断开连接")
+    except asyncio.CancelledError:
+        # 处理函数本身被取消时同样取消上游请求，并等待其清理完成（关闭上游连接、退出排队），
+        # 避免清理在后台继续运行并与之后关闭生成器的操作冲突
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await asyncio.wait({task})
+        raise
+
+
+async def iter_until_disconnected(request, iterator: AsyncIterator[T],
+                                  poll_interval: float = DISCONNECT_POLL_INTERVAL) -> AsyncIterator[T]:
+    """
+    逐项转发异步生成器的输出，客户端断开时取消当前等待并关闭生成器（关闭上游连接）
+
+    Args:
+        request: aiohttp.web.Request 对象
+        iterator: 上游服务的异步生成器
+        poll_interval: 检查客户端连接状态的间隔（秒）
+
+    Yields:
+        生成器的每一项
+
+    Raises:
+        ClientDisconnectedError: 客户端在生成结束前断开连接
+    """
+    try:
+        while True:
+            try:
+                item = await run_until_disconnected(request, iterator.__anext__(), poll_interval)
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        aclose = getattr(iterator, 'aclose', None)
+        if aclose is not None:
+            await aclose()
@@ -1,9 +1,11 @@
 # ai_services/utils/handler_loader.py
+import hashlib
 import importlib.util
 import sys
+import threading
 from pathlib import Path
 import os
-from typing import Callable, Any, Optional
+from typing import Callable, Any, Dict, Optional, Tuple
 
 # 正确获取ai_services目录
 ai_services_dir = Path(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -11,57 +13,172 @@ ai_services_dir = Path(os.path.dirname(os.path.dirname(os.path.abspath(__file__)
 handlers_dir = ai_services_dir / "handlers"
 handlers_dir.mkdir(exist_ok=True)  # 确保目录存在
 
-def load_handler_function(module_path: str, function_name: str) -> Optional[Callable]:
+# 开发模式热重载：开启后每次获取处理函数都检查文件是否变化，变化时重新加载模块；
+# 关闭时模块只在首次使用时加载。可通过环境变量 AI_ASSISTANT_HANDLER_HOT_RELOAD=1 开启
+HOT_RELOAD = os.environ.get("AI_ASSISTANT_HANDLER_HOT_RELOAD", "").lower() in ("1", "true", "yes")
+
+def get_handler_file(module_path: str) -> Path:
     """
-    动态加载指定模块中的处理函数，每次调用都重新加载模块
+    获取处理函数模块文件的完整路径
     
     Args:
         module_path: 模块文件名或相对路径 (相对于handlers目录)
-        function_name: 函数名称
         
     Returns:
-        加载的函数对象，如果加载失败则返回None
+        模块文件路径
+    """
+    if not module_path.endswith('.py'):
+        module_path += '.py'
+    return handlers_dir / module_path
+
+class HandlerRegistry:
+    """
+    处理函数注册表
+    
+    缓存已加载的模块和函数，获取处理函数通常只是一次字典查找；
+    热重载模式下文件的修改时间或大小变化且内容哈希不同时才重新执行模块
     """
-    try:
-        # 构建完整的文件路径
-        if not module_path.endswith('.py'):
-            module_path += '.py'
+    
+    def __init__(self, hot_reload: bool = False):
+        self.hot_reload = hot_reload
+        # 文件路径 -> {"module": 模块对象, "stat": (mtime_ns, size), "digest": 内容哈希}
+        self._modules: Dict[Path, Dict[str, Any]] = {}
+        # (module_path, function_name) -> (函数对象, 所属模块对象)
+        self._functions: Dict[Tuple[str, str], Tuple[Callable, Any]] = {}
+        self._lock = threading.RLock()
+    
+    def get_function(self, module_path: str, function_name: str) -> Optional[Callable]:
+        """
+        获取处理函数
+        
+        Args:
+            module_path: 模块文件名或相对路径 (相对于handlers目录)
+            function_name: 函数名称
             
-        full_path = handlers_dir / module_path
+        Returns:
+            函数对象，如果加载失败则返回None
+        """
+        key = (module_path, function_name)
+        cached = self._functions.get(key)
+        if cached is not None and not self.hot_reload:
+            return cached[0]
+        
+        with self._lock:
+            module = self._get_module(get_handler_file(module_path), module_path)
+            if module is None:
+                return None
+            if cached is not None and cached[1] is module:
+                return cached[0]
+            
+            # 获取函数
+            function = getattr(module, function_name, None)
+            if function is None:
+                print(f"函数 {function_name} 在模块 {get_handler_file(module_path)} 中不存在")
+                return None
+            self._functions[key] = (function, module)
+            return function
+    
+    def get_version(self, module_path: str) -> str:
+        """
+        获取当前使用的模块版本（模块文件内容哈希），模块无法加载时返回空字符串
+        
+        Args:
+            module_path: 模块文件名或相对路径 (相对于handlers目录)
+        """
+        full_path = get_handler_file(module_path)
+        with self._lock:
+            if self._get_module(full_path, module_path) is None:
+                return ""
+            return self._modules[full_path]["digest"]
+    
+    def invalidate(self) -> None:
+        """清空缓存，下次使用时重新加载所有模块"""
+        with self._lock:
+            self._modules.clear()
+            self._functions.clear()
+    
+    def _get_module(self, full_path: Path, module_path: str):
+        """获取已加载的模块，未加载或（热重载模式下）文件内容变化时重新加载"""
+        entry = self._modules.get(full_path)
+        if entry is not None and not self.hot_reload:
+            return entry["module"]
         
         # 检查文件是否存在
-        if not full_path.exists():
+        try:
+            stat = full_path.stat()
+        except OSError:
             print(f"模块文件不存在: {full_path}")
             return None
+        file_stat = (stat.st_mtime_ns, stat.st_size)
+        if entry is not None and entry["stat"] == file_stat:
+            return entry["module"]
         
-        # 从文件名获取模块名 (不包含.py扩展名)
-        module_name = f"ai_services.handlers.{Path(module_path).stem}"
-        
-        # 如果模块已在sys.modules中，先移除它
-        if module_name in sys.modules:
-            del sys.modules[module_name]
-        
-        # 每次都重新加载模块
-        spec = importlib.util.spec_from_file_location(module_name, full_path)
-        if spec is None:
-            print(f"无法找到模块: {full_path}")
+        try:
+            source = full_path.read_bytes()
+        except OSError as e:
+            print(f"读取模块文件失败: {e}")
             return None
-            
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
+        digest = hashlib.sha256(source).hexdigest()
+        if entry is not None and entry["digest"] == digest:
+            # 只是修改时间变化，内容相同时不重新加载
+            entry["stat"] = file_stat
+            return entry["module"]
         
-        # 获取函数
-        if hasattr(module, function_name):
-            return getattr(module, function_name)
-        else:
-            print(f"函数 {function_name} 在模块 {full_path} 中不存在")
+        module = self._load_module(full_path, module_path)
+        if module is None:
             return None
+        self._modules[full_path] = {"module": module, "stat": file_stat, "digest": digest}
+        return module
+    
+    @staticmethod
+    def _load_module(full_path: Path, module_path: str):
+        """执行模块文件，返回模块对象"""
+        try:
+            # 从文件名获取模块名 (不包含.py扩展名)
+            module_name = f"ai_services.handlers.{Path(module_path).stem}"
+            
+            # 如果模块已在sys.modules中，先移除它
+            if module_name in sys.modules:
+                del sys.modules[module_name]
             
-    except Exception as e:
-        print(f"加载处理函数时出错: {e}")
-        import traceback
-        traceback.print_exc()
-        return None
+            spec = importlib.util.spec_from_file_location(module_name, full_path)
+            if spec is None:
+                print(f"无法找到模块: {full_path}")
+                return None
+                
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            return module
+            
+        except Exception as e:
+            print(f"加载处理函数时出错: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+
+# 全局处理函数注册表
+handler_registry = HandlerRegistry(HOT_RELOAD)
+
+def set_hot_reload(enabled: bool) -> None:
+    """开启或关闭处理函数热重载（开发模式）"""
+    handler_registry.hot_reload = bool(enabled)
+
+def get_handler_version(module_path: str) -> str:
+    """获取当前使用的处理函数模块版本，模块内容变化并重新加载后版本随之变化"""
+    return handler_registry.get_version(module_path)
+
+def load_handler_function(module_path: str, function_name: str) -> Optional[Callable]:
+    """
+    获取指定模块中的处理函数，模块只在首次使用（或热重载模式下文件变化）时加载
+    
+    Args:
+        module_path: 模块文件名或相对路径 (相对于handlers目录)
+        function_name: 函数名称
+        
+    Returns:
+        加载的函数对象，如果加载失败则返回None
+    """
+    return handler_registry.get_function(module_path, function_name)
 
 def process_ai_response(prompt_config: dict, ai_response: str, **kwargs) -> Any:
     """
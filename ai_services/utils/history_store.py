@@ -0,0 +1,365 @@
+# ai_services/utils/history_store.py
+"""
+历史记录存储
+定义历史记录存储接口，并提供基于 SQLite（WAL 模式）的实现
+"""
+import json
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+# 单独存储为列的记录字段，其余字段存入 extra 列
+RECORD_COLUMNS = ('message_id', 'type', 'user', 'assistant')
+
+# 每次向存储预留的消息ID数量
+MESSAGE_ID_BLOCK_SIZE = 50
+
+
+class MessageIdAllocator:
+    """
+    消息ID分配器
+
+    在内存中递增分配ID，每用完一批才向存储预留下一批（一次写入），
+    分配过程加锁，事件循环和线程池中的并发请求不会拿到重复ID。
+    重启后未用完的预留ID会被跳过，ID 单调递增但可能不连续。
+    """
+
+    def __init__(self, store: 'HistoryStore', block_size: int = MESSAGE_ID_BLOCK_SIZE):
+        self.store = store
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._block_end = -1  # 当前预留区间的最后一个ID（包含）
+
+    def next_id(self) -> int:
+        """分配下一个消息ID"""
+        with self._lock:
+            if self._next_id > self._block_end:
+                self._next_id, self._block_end = self.store.reserve_message_ids(self.block_size)
+            message_id = self._next_id
+            self._next_id += 1
+            return message_id
+
+    def reset(self) -> None:
+        """丢弃当前预留区间，下次分配时重新预留"""
+        with self._lock:
+            self._next_id = 0
+            self._block_end = -1
+
+
+class HistoryStore(ABC):
+    """历史记录存储接口"""
+
+    def __init__(self):
+        self._allocator = MessageIdAllocator(self)
+
+    @abstractmethod
+    def get_last_message_id(self) -> int:
+        """获取已保存记录中最大的消息ID，没有记录时返回 0"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def reserve_message_ids(self, count: int) -> Tuple[int, int]:
+        """持久化预留 count 个连续的消息ID，返回 (起始ID, 结束ID)，两端都包含"""
+        raise NotImplementedError
+
+    def next_message_id(self) -> int:
+        """分配下一个消息ID"""
+        return self._allocator.next_id()
+
+    @abstractmethod
+    def save(self, record: Dict[str, Any]) -> None:
+        """保存（插入或覆盖）一条记录"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, message_id: int, record_type: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """按消息ID获取记录，record_type 不为空时只返回该类型的记录"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_before(self, before_id: Optional[int], limit: int,
+                    record_type: Optional[str] = None) -> List[Dict[str, Any]]:
+        """按 message_id 倒序获取小于 before_id 的最多 limit 条记录，before_id 为空时从最新记录开始"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def count(self) -> int:
+        """获取记录总数"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def clear(self) -> None:
+        """清空所有记录并重置消息ID"""
+        raise NotImplementedError
+
+    def get_renders(self, message_ids: List[int]) -> Dict[int, Tuple[str, str]]:
+        """获取缓存的渲染结果 {message_id: (render_key, html)}，默认不缓存"""
+        return {}
+
+    def save_renders(self, renders: List[Tuple[int, str, str]]) -> None:
+        """保存渲染结果 [(message_id, render_key, html)]，默认不缓存"""
+        pass
+
+    def close(self) -> None:
+        """关闭存储"""
+        pass
+
+
+class SqliteHistoryStore(HistoryStore):
+    """
+    基于 SQLite 的历史记录存储
+
+    使用 WAL 模式，message_id 为主键，(prompt_id, type) 和 (type, message_id) 建立索引，
+    user/assistant 以 JSON 文本列存储。连接可在事件循环和线程池之间共享。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id INTEGER PRIMARY KEY,
+            type TEXT NOT NULL,
+            prompt_id TEXT,
+            user TEXT NOT NULL,
+            assistant TEXT NOT NULL,
+            extra TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_prompt_type ON messages (prompt_id, type);
+        CREATE INDEX IF NOT EXISTS idx_messages_type_id ON messages (type, message_id);
+        CREATE TABLE IF NOT EXISTS metadata (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS renders (
+            message_id INTEGER PRIMARY KEY,
+            render_key TEXT NOT NULL,
+            html TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, db_path: Path):
+        super().__init__()
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+
+    def _get_meta(self, key: str, default: Any = None) -> Any:
+        """读取元数据"""
+        row = self._conn.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_meta(self, key: str, value: Any) -> None:
+        """写入元数据"""
+        self._conn.execute(
+            "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
+            (key, json.dumps(value))
+        )
+
+    def get_meta(self, key: str, default: Any = None) -> Any:
+        """读取元数据"""
+        with self._lock:
+            return self._get_meta(key, default)
+
+    def set_meta(self, key: str, value: Any) -> None:
+        """写入元数据"""
+        with self._lock:
+            self._set_meta(key, value)
+
+    def get_last_message_id(self) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT MAX(message_id) FROM messages").fetchone()
+        return int(row[0] or 0)
+
+    def reserve_message_ids(self, count: int) -> Tuple[int, int]:
+        # last_message_id 元数据记录已预留的最大ID
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                reserved = int(self._get_meta('last_message_id', 0))
+                saved = self._conn.execute("SELECT MAX(message_id) FROM messages").fetchone()[0] or 0
+                start = max(reserved, int(saved)) + 1
+                end = start + count - 1
+                self._set_meta('last_message_id', end)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return start, end
+
+    @staticmethod
+    def _to_row(record: Dict[str, Any]) -> tuple:
+        """记录字典转换为数据库行"""
+        user = record.get('user') or {}
+        extra = {k: v for k, v in record.items() if k not in RECORD_COLUMNS}
+        return (
+            int(record['message_id']),
+            record['type'],
+            user.get('prompt_id'),
+            json.dumps(user, ensure_ascii=False),
+            json.dumps(record.get('assistant') or {}, ensure_ascii=False),
+            json.dumps(extra, ensure_ascii=False) if extra else None
+        )
+
+    @staticmethod
+    def _from_row(row: tuple) -> Dict[str, Any]:
+        """数据库行转换为记录字典"""
+        message_id, record_type, user, assistant, extra = row
+        record = {
+            'message_id': message_id,
+            'type': record_type,
+            'user': json.loads(user),
+            'assistant': json.loads(assistant)
+        }
+        if extra:
+            record.update(json.loads(extra))
+        return record
+
+    def save(self, record: Dict[str, Any]) -> None:
+        row = self._to_row(record)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO messages (message_id, type, prompt_id, user, assistant, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                row
+            )
+
+    def import_records(self, records, metadata: Optional[Dict[str, Any]] = None) -> int:
+        """在一个事务中批量保存记录并写入元数据，返回保存条数"""
+        rows = [self._to_row(record) for record in records]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO messages (message_id, type, prompt_id, user, assistant, extra) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+                for key, value in (metadata or {}).items():
+                    self._set_meta(key, value)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def get(self, message_id: int, record_type: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        sql = "SELECT message_id, type, user, assistant, extra FROM messages WHERE message_id = ?"
+        params = [int(message_id)]
+        if record_type is not None:
+            sql += " AND type = ?"
+            params.append(record_type)
+        with self._lock:
+            row = self._conn.execute(sql, params).fetchone()
+        return self._from_row(row) if row else None
+
+    def list_before(self, before_id: Optional[int], limit: int,
+                    record_type: Optional[str] = None) -> List[Dict[str, Any]]:
+        conditions = []
+        params: List[Any] = []
+        if before_id is not None:
+            conditions.append("message_id < ?")
+            params.append(int(before_id))
+        if record_type is not None:
+            conditions.append("type = ?")
+            params.append(record_type)
+        sql = "SELECT message_id, type, user, assistant, extra FROM messages"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY message_id DESC LIMIT ?"
+        params.append(int(limit))
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [self._from_row(row) for row in rows]
+
+    def get_renders(self, message_ids: List[int]) -> Dict[int, Tuple[str, str]]:
+        if not message_ids:
+            return {}
+        placeholders = ",".join("?" * len(message_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT message_id, render_key, html FROM renders WHERE message_id IN ({placeholders})",
+                [int(message_id) for message_id in message_ids]
+            ).fetchall()
+        return {message_id: (render_key, html) for message_id, render_key, html in rows}
+
+    def save_renders(self, renders: List[Tuple[int, str, str]]) -> None:
+        if not renders:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO renders (message_id, render_key, html) VALUES (?, ?, ?)",
+                renders
+            )
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM messages")
+                self._conn.execute("DELETE FROM renders")
+                self._set_meta('last_message_id', 0)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._allocator.reset()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def migrate_tinydb_history(tinydb_file: Path, store: SqliteHistoryStore) -> int:
+    """
+    将旧的 TinyDB 历史记录文件一次性导入 SQLite 存储
+
+    只在存储为空且尚未迁移过时执行，旧文件保持不变。
+    旧文件读取失败时不标记为已迁移，下次打开存储时重试。
+
+    Args:
+        tinydb_file: TinyDB JSON 文件路径
+        store: 目标存储
+
+    Returns:
+        导入的记录条数
+    """
+    tinydb_file = Path(tinydb_file)
+    if store.get_meta('tinydb_migrated', False):
+        return 0
+    if not tinydb_file.exists() or store.count() > 0:
+        store.set_meta('tinydb_migrated', True)
+        return 0
+
+    try:
+        with open(tinydb_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"读取旧历史记录失败，稍后重试迁移: {str(e)}")
+        return 0
+
+    records = [
+        record for record in (data.get('_default') or {}).values()
+        if isinstance(record, dict) and all(key in record for key in ('message_id', 'type'))
+    ]
+    last_message_id = 0
+    for item in (data.get('_metadata') or {}).values():
+        if isinstance(item, dict) and item.get('key') == 'last_message_id':
+            last_message_id = int(item.get('value') or 0)
+    if records:
+        last_message_id = max(last_message_id, max(int(r['message_id']) for r in records))
+
+    imported = store.import_records(records, {
+        'last_message_id': last_message_id,
+        'tinydb_migrated': True
+    })
+    print(f"已将 {imported} 条历史记录从 TinyDB 迁移到 SQLite")
+    return imported
@@ -4,8 +4,10 @@ import re
 import markdown2  # 添加 markdown2 库来处理 Markdown
 from bs4 import BeautifulSoup, Tag
 import logging
-from ..utils.handler_loader import load_handler_function
-from ..prompt_api import load_prompt_data
+import os
+from html import escape as html_escape, unescape as html_unescape
+from ..utils.handler_loader import get_handler_version
+from ..prompt_api import load_prompt_data, load_prompt_handler
 from bs4 import BeautifulSoup
 from jsonfinder import jsonfinder
 import re
@@ -46,6 +48,26 @@ class HtmlParser:
             # 其他安全的事件处理程序模式
         ]
     }
+    
+    # format_code_blocks 的保护规则（单次扫描，按顺序尝试）：
+    # Markdown 代码块和行内代码原样保留交给 markdown2，已格式化的代码块和其他 HTML 元素替换为占位符
+    PROTECT_PATTERN = re.compile(
+        r'(?P<fence>^[ \t]*```[\s\S]*?^[ \t]*```)'
+        r'|(?P<inline>`[^`\n]+`)'
+        r'|(?P<block><div\s+class=["\']code-block["\'][^>]*>[\s\S]*?</pre>\s*</div>)'
+        r'|<(?P<tag>\w+)(?:\s+[^>]*)?(?:>[\s\S]*?</(?P=tag)>|/>)',
+        re.MULTILINE
+    )
+    # 占位符使用正文中不会出现的控制字符，markdown2 不会改写
+    PLACEHOLDER_PATTERN = re.compile(r'<p>\x02(\d+)\x03</p>|\x02(\d+)\x03')
+    # 单独成段时去掉外层 <p> 的块级元素
+    BLOCK_TAG_PATTERN = re.compile(
+        r'<(?:div|pre|p|h[1-6]|ul|ol|li|table|blockquote|details|section|form|hr)\b', re.IGNORECASE)
+    # markdown2 输出的代码块
+    PRE_CODE_PATTERN = re.compile(r'<pre><code(?:\s+class="([^"]*)")?>([\s\S]*?)</code></pre>')
+    
+    # parse_dynamic_tags_text_new 的词法单元：Markdown 代码块标记或 HTML 标签
+    DYNAMIC_TOKEN_PATTERN = re.compile(r'```|<(/?)([A-Za-z][\w:.-]*)([^<>]*)>')
 
     @classmethod
     def parse_ai_response(cls, content: str) -> str:
@@ -198,6 +220,26 @@ class HtmlParser:
 
         return code_block
 
+    @classmethod
+    def render_code_block(cls, code_content: str, lang: str = 'plaintext') -> str:
+        """
+        生成代码块 HTML，结构与 create_code_block 相同
+
+        Args:
+            code_content: 代码内容
+            lang: 编程语言
+
+        Returns:
+            代码块 HTML 字符串
+        """
+        lang_attr = html_escape(lang)
+        return (
+            '<div class="code-block"><div class="code-header">'
+            f'<span class="code-lang">{html_escape(lang, quote=False)}</span>'
+            '<button class="copy-button" onclick="copyCode(this)">复制</button></div>'
+            f'<pre><code class="language-{lang_attr}">{html_escape(code_content, quote=False)}</code></pre></div>'
+        )
+
     @classmethod
     def format_code_blocks(cls, content: str) -> str:
         """格式化代码块，添加语法高亮"""
@@ -206,77 +248,48 @@ class HtmlParser:
             if not content or content.strip() == '':
                 return content
             
-            # 预处理：保护已有的 HTML 元素块
-            protected_blocks = {}
-            block_id = 0
-            
-            # 保护 <div class="code-block"> 已经格式化的代码块
-            def protect_existing_code_blocks(match):
-                nonlocal block_id
-                placeholder = f"__PROTECTED_CODE_BLOCK_{block_id}__"
-                protected_blocks[placeholder] = match.group(0)
-                block_id += 1
-                return placeholder
-            
-            # 保护其他 HTML 元素
-            def protect_html_elements(match):
-                nonlocal block_id
+            # 预处理：单次扫描，将已格式化的代码块和其他 HTML 元素替换为占位符
+            protected_blocks = []
+            
+            def protect(match):
+                if match.group('fence') or match.group('inline'):
+                    return match.group(0)
                 # 排除 pre 和 code 标签，它们需要特殊处理
-                tag = match.group(1).lower()
-                if tag in ['pre', 'code']:
+                tag = match.group('tag')
+                if tag and tag.lower() in ('pre', 'code'):
                     return match.group(0)
-                
-                placeholder = f"__PROTECTED_HTML_{block_id}__"
-                protected_blocks[placeholder] = match.group(0)
-                block_id += 1
-                return placeholder
-            
-            # 保护已有的代码块
-            content = re.sub(
-                r'<div\s+class=["\']code-block["\'][^>]*>[\s\S]*?</div>',
-                protect_existing_code_blocks,
-                content
-            )
-            
-            # 保护其他 HTML 元素 (排除 pre 和 code)
-            content = re.sub(
-                r'<(\w+)(?:\s+[^>]*)?(?:>[\s\S]*?</\1>|/>)',
-                protect_html_elements,
-                content
-            )
-            
-            # 使用 markdown2 处理 Markdown 内容
-            html_content = markdown2.markdown(content, extras=['fenced-code-blocks'])
-            
-            # 使用 html5lib 解析 HTML (更准确的解析)
-            soup = BeautifulSoup(html_content, 'html5lib')
+                protected_blocks.append(match.group(0))
+                return f"\x02{len(protected_blocks) - 1}\x03"
+            
+            protected_content = cls.PROTECT_PATTERN.sub(protect, content)
+            
+            # 使用 markdown2 处理 Markdown 内容（highlightjs-lang 保留语言标识且不调用 pygments）
+            html_content = markdown2.markdown(protected_content, extras=['fenced-code-blocks', 'highlightjs-lang'])
             
             # 处理代码块
-            for pre in soup.find_all('pre'):
-                code = pre.find('code')
-                if code and code.parent == pre:
-                    # 获取语言类名
-                    lang = code.get('class', ['language-plaintext'])[0].replace('language-', '') if code.get('class') else 'plaintext'
-                    
-                    # 获取代码内容，保留换行符和空格
-                    code_content = code.get_text(strip=False)
-                    # 只清理开头和结尾的空白
-                    code_content = code_content.strip('\n\r\t ')
-                    
-                    # 创建新的代码块
-                    code_block = cls.create_code_block(code_content, lang)
-                    
-                    # 替换原始的 pre 标签
-                    pre.replace_with(code_block)
-            
-            # 获取处理后的 HTML
-            result = str(soup.body).replace('<body>', '').replace('</body>', '')
-            
-            # 恢复被保护的块
-            for placeholder, original in protected_blocks.items():
-                result = result.replace(placeholder, original)
-            
-            return result
+            def replace_code_block(match):
+                # 获取语言类名
+                classes = (match.group(1) or '').split()
+                lang = classes[0].replace('language-', '') if classes else 'plaintext'
+                # 获取代码内容，只清理开头和结尾的空白
+                code_content = html_unescape(match.group(2)).strip('\n\r\t ')
+                return cls.render_code_block(code_content, lang)
+            
+            result = cls.PRE_CODE_PATTERN.sub(replace_code_block, html_content)
+            
+            # 单次恢复被保护的块，单独成段的块级元素去掉外层 <p>
+            def restore(match):
+                if match.group(1) is not None:
+                    original = protected_blocks[int(match.group(1))]
+                    if cls.BLOCK_TAG_PATTERN.match(original):
+                        return original
+                    return f"<p>{original}</p>"
+                return protected_blocks[int(match.group(2))]
+            
+            if protected_blocks:
+                result = cls.PLACEHOLDER_PATTERN.sub(restore, result)
+            
+            return result.strip()
             
         except Exception as e:
             logger.error(f"格式化代码块失败: {str(e)}")
@@ -305,7 +318,7 @@ class HtmlParser:
         if prompt_data and prompt_data.get('prompt_fun') and prompt_data.get('prompt_fun_path'):
             try:
                 # 加载处理函数
-                prompt_fun = load_handler_function(prompt_data.get('prompt_fun_path'), prompt_data.get('prompt_fun'))
+                prompt_fun = load_prompt_handler(prompt_id, 'prompt_fun')
                 if prompt_fun:
                     # 执行处理函数
                     formatted_content = prompt_fun(content)
@@ -321,6 +334,52 @@ class HtmlParser:
             # 没有处理函数配置时使用默认格式化
             return cls.format_code_blocks(content)
         
+    @classmethod
+    def create_incremental_formatter(cls, prompt_id: str = None):
+        """
+        为流式回复创建增量格式化器
+        
+        配置了处理函数的提示词需要完整内容才能处理，此时返回 None，
+        应在流结束后调用 process_content_by_prompt
+        
+        Args:
+            prompt_id: 提示词ID
+            
+        Returns:
+            IncrementalFormatter 对象或 None
+        """
+        prompt_data = load_prompt_data(prompt_id) if prompt_id else None
+        if prompt_data and prompt_data.get('prompt_fun') and prompt_data.get('prompt_fun_path'):
+            return None
+        return IncrementalFormatter(cls.format_code_blocks)
+        
+    @classmethod
+    def get_formatter_version(cls, prompt_id: str = None) -> str:
+        """
+        获取 process_content_by_prompt 使用的格式化器版本
+        
+        由本模块的修改时间和当前加载的提示词处理函数模块版本组成，格式化代码变化后版本随之变化，
+        用于判断缓存的渲染结果是否仍然有效
+        
+        Args:
+            prompt_id: 提示词ID
+            
+        Returns:
+            版本字符串
+        """
+        def file_mtime(path):
+            try:
+                return os.stat(path).st_mtime_ns
+            except OSError:
+                return 0
+        
+        parts = [f"html_parser:{file_mtime(__file__)}"]
+        prompt_data = load_prompt_data(prompt_id) if prompt_id else None
+        if prompt_data and prompt_data.get('prompt_fun') and prompt_data.get('prompt_fun_path'):
+            handler_version = get_handler_version(prompt_data.get('prompt_fun_path'))
+            parts.append(f"{prompt_data.get('prompt_fun_path')}:{prompt_data.get('prompt_fun')}:{handler_version}")
+        return "|".join(parts)
+        
     @classmethod
     def process_content_by_prompt_run(cls, prompt_id: str = None) -> str:
         """
@@ -343,7 +402,7 @@ class HtmlParser:
         if prompt_data and prompt_data.get('prompt_run') and prompt_data.get('prompt_run_path'):
             try:
                 # 加载处理函数
-                prompt_run = load_handler_function(prompt_data.get('prompt_run_path'), prompt_data.get('prompt_run'))
+                prompt_run = load_prompt_handler(prompt_id, 'prompt_run')
                 if prompt_run:
                     # 执行处理函数
                     formatted_content = prompt_run()
@@ -416,165 +475,106 @@ class HtmlParser:
     
         return groups
     
-    @classmethod
-    def parse_dynamic_tags_text(cls, content: str):
-        groups = {'html': [], 'json': [], 'text': []}  # 存储解析结果
-        stack = []  # 用于处理嵌套标签
-        buffer = ''  # 当前正在处理的内容缓冲区
-        i = 0  # 指针位置
-    
-        while i < len(content):
-            char = content[i]
-    
-            # 检测标签起始
-            if char == '<':
-                # 如果缓冲区有内容，存储为普通文本
-                if buffer.strip():
-                    if stack:
-                        # 如果在标签内，作为标签内容
-                        groups['html'].append(f"<{stack[-1]}> {buffer.strip()} </{stack[-1]}>")
-                    else:
-                        # 如果不在标签内，作为普通文本
-                        groups['text'].append(buffer.strip())
-                    buffer = ''  # 清空缓冲区
-    
-                # 解析标签名称
-                tag_start = i + 1
-                tag_end = content.find('>', tag_start)
-                if tag_end == -1:
-                    raise ValueError("未闭合的标签")
-                tag_name = content[tag_start:tag_end].strip()
-    
-                # 检测结束标签
-                if tag_name.startswith('/'):
-                    tag_name = tag_name[1:]  # 去掉结束标签的斜杠
-                    if stack and stack[-1] == tag_name:
-                        stack.pop()  # 弹出匹配的开始标签
-                    else:
-                        raise ValueError(f"标签不匹配：{tag_name}")
-                else:
-                    stack.append(tag_name)  # 推入栈中
-    
-                i = tag_end  # 移动指针到标签结束位置
-    
-            # 检测普通字符
-            else:
-                buffer += char
-    
-            i += 1
-    
-        # 处理剩余的缓冲区内容
-        if buffer.strip():
-            if stack:
-                groups['html'].append(f"<{stack[-1]}> {buffer.strip()} </{stack[-1]}>")
-            else:
-                groups['text'].append(buffer.strip())
-    
-        # 返回解析结果
-        return groups
-    
     @classmethod
     def parse_dynamic_tags_text_new(cls, content: str):
         """
-        逐字解析内容，发现特定特征块时调用 parse_dynamic_tags 处理，并支持 Markdown 代码块和 JSON 数据的提取。
+        单次向前扫描内容，按出现顺序提取普通文本、HTML 标签块和 Markdown 代码块
+        
+        每个标签块从开始标签延伸到匹配的结束标签（同名标签嵌套时按层级匹配），
+        没有结束标签时延伸到内容末尾；多余的结束标签被忽略。
         
         Args:
             content: 待解析的文本内容。
             
         Returns:
-            dict: 按类型分类的解析结果。
+            dict: {'groups': 按类型分类的解析结果, 'ordered_groups': 按顺序排列的 (类型, 内容) 列表}
+            
+        Raises:
+            ValueError: Markdown 代码块未闭合
         """
-        print(content)
         groups = {'html': [], 'json': [], 'text': [], 'code': []}  # 按类型分类存储
-        content,groups_json = cls.parse_content_json(content)
+        content, groups_json = cls.parse_content_json(content)
         groups['json'] = groups_json
-        print(content,groups_json)
-
         ordered_groups = []  # 按顺序存储解析结果
-        tag_types = cls.get_tags_type(content)  # 缓存所有标签类型
-        max_iterations = 10000  # 最大循环次数，防止死循环
-        iteration_count = 0  # 当前循环次数
-
-        while content.strip():  # 循环处理剩余内容
-            iteration_count += 1
-            if iteration_count > max_iterations:
-                raise RuntimeError("解析过程中出现死循环，已达到最大循环次数")
-    
-            buffer = ''  # 当前正在处理的内容缓冲区
-            i = 0  # 指针位置
-            content_length = len(content)  # 当前内容长度
-    
-            while i < content_length:
-                char = content[i]
-    
-    
-                # 检测 Markdown 代码块
-                if content[i:i+3] == '```':
-                    # 提取 Markdown 代码块
-                    end_index = content.find('```', i + 3)
-                    if end_index == -1:
-                        raise ValueError("未闭合的 Markdown 代码块")
-                    markdown_block = content[i+3:end_index].strip()
-                    groups['code'].append(markdown_block)
-                    ordered_groups.append(('code', markdown_block))  # 按顺序存储
-                    content = content[:i] + content[end_index+3:]  # 跳过已处理的代码块
-                    content_length = len(content)  # 更新内容长度
-                    break  # 跳出当前循环，重新处理剩余内容
-    
-                # 检测 HTML 标签起始
-                elif char == '<':
-                    # 如果缓冲区有内容，存储为普通文本
-                    if buffer.strip():
-                        groups['text'].append(buffer.strip())
-                        ordered_groups.append(('text', buffer.strip()))  # 按顺序存储
-                        buffer = ''  # 清空缓冲区
-    
-                    # 检测特定块
-                    tag_start = i + 1
-                    tag_end = content.find('>', tag_start)
-                    if tag_end == -1:
-                        raise ValueError("未闭合的标签")
-                    tag_name = content[tag_start:tag_end].strip()
-    
-                    # 检测是否为特定块
-                    if tag_name in tag_types:
-                        # 调用 get_tags_value 提取标签内容
-                        parsed_result, remaining_content = cls.get_tags_value(content, tag_name)
-    
-                        # 根据标签类型存储解析结果
-                        if tag_name == 'code':
-                            groups['code'].extend(parsed_result)
-                            ordered_groups.extend([('code', item) for item in parsed_result])  # 按顺序存储
-                        elif tag_name == 'json':
-                            groups['json'].extend(parsed_result)
-                            ordered_groups.extend([('json', item) for item in parsed_result])  # 按顺序存储
-                        else:
-                            groups['html'].extend(parsed_result)
-                            ordered_groups.extend([('html', item) for item in parsed_result])  # 按顺序存储
-    
-                        # 更新 content 为剩余未处理的内容
-                        content = remaining_content
-                        content_length = len(content)  # 更新内容长度
-                        break  # 跳出当前循环，重新处理剩余内容
-                    else:
-                        # 非特定块，作为普通 HTML 处理
-                        buffer += char
-    
-                else:
-                    # 普通字符，加入缓冲区
-                    buffer += char
-    
-                i += 1
-
-    
-            # 处理剩余的缓冲区内容
-            if buffer.strip():
-                groups['text'].append(buffer.strip())
-                ordered_groups.append(('text', buffer.strip()))  # 按顺序存储
-                content = content[len(buffer):]  # 更新 content，移除已处理的部分
-    
+        
+        def add_item(item_type, item):
+            if item_type == 'json':
+                groups['json']['json'].append(item)
+            else:
+                groups[item_type].append(item)
+            ordered_groups.append((item_type, item))
+        
+        def add_text(text):
+            text = text.strip()
+            if text:
+                add_item('text', text)
+        
+        pos = 0  # 尚未输出的内容起点
+        search_pos = 0  # 下一个词法单元的查找起点
+        length = len(content)
+        while search_pos < length:
+            match = cls.DYNAMIC_TOKEN_PATTERN.search(content, search_pos)
+            if match is None:
+                break
+            
+            # Markdown 代码块
+            if match.group(0) == '```':
+                end_index = content.find('```', match.end())
+                if end_index == -1:
+                    raise ValueError("未闭合的 Markdown 代码块")
+                add_text(content[pos:match.start()])
+                add_item('code', content[match.end():end_index].strip())
+                pos = search_pos = end_index + 3
+                continue
+            
+            closing, tag_name, attrs = match.group(1), match.group(2).lower(), match.group(3)
+            add_text(content[pos:match.start()])
+            pos = search_pos = match.end()
+            if closing:
+                # 多余的结束标签
+                continue
+            
+            if tag_name in ContentTagScanner.VOID_TAGS or attrs.rstrip().endswith('/'):
+                add_item('html', match.group(0))
+                continue
+            
+            inner_end, block_end = cls._find_closing_tag(content, tag_name, match.end())
+            inner = content[match.end():inner_end]
+            if tag_name in ('code', 'json'):
+                add_item(tag_name, inner.strip())
+            elif block_end is None:
+                add_item('html', f"{content[match.start():]}</{tag_name}>")
+            else:
+                add_item('html', content[match.start():block_end])
+            pos = search_pos = block_end if block_end is not None else length
+        
+        add_text(content[pos:])
         return {'groups': groups, 'ordered_groups': ordered_groups}
     
+    @staticmethod
+    def _find_closing_tag(content: str, tag_name: str, start: int):
+        """
+        查找与开始标签匹配的结束标签，同名标签嵌套时按层级匹配
+        
+        Args:
+            content: 文本内容
+            tag_name: 标签名（小写）
+            start: 开始标签之后的位置
+            
+        Returns:
+            (标签内容结束位置, 结束标签之后的位置)；没有结束标签时为 (内容长度, None)
+        """
+        pattern = re.compile(r'<(/?)%s(?=[\s/>])[^<>]*>' % re.escape(tag_name), re.IGNORECASE)
+        depth = 1
+        for match in pattern.finditer(content, start):
+            if match.group(1):
+                depth -= 1
+                if depth == 0:
+                    return match.start(), match.end()
+            elif not match.group(0).endswith('/>'):
+                depth += 1
+        return len(content), None
+    
     @classmethod
     def render_ordered_groups_as_html(cls, content: str):
         """
@@ -616,39 +616,6 @@ class HtmlParser:
         
         # 拼接所有内容为一个完整的 HTML 字符串
         return "\n".join(html_output)
-    @classmethod
-    def get_tags_type(cls, content: str):
-        """
-        动态获取所有存在的标签类型。
-        
-        Args:
-            content: HTML 内容。
-            
-        Returns:
-            set: 包含所有标签类型的集合。
-        """
-        soup = BeautifulSoup(content, 'html.parser')
-        tag_types = {tag.name for tag in soup.find_all(True)}
-        print(f"发现的标签类型: {tag_types}")  # 可选调试输出
-        return tag_types
-    
-    @classmethod
-    def get_tags_value(cls, content: str, tag_type: str):
-        """
-        提取指定标签类型的全部内容（包括标签本身及其内部内容）。
-        """
-        soup = BeautifulSoup(content, 'html.parser')
-        tags = soup.find_all(tag_type)
-        tag_values = [str(tag) for tag in tags]
-        print(f"发现的标签内容: {tag_values}")  # 可选调试输出
-
-        # 移除已处理的标签
-        for tag in tags:
-            tag.decompose()
-
-        remaining_content = str(soup)
-        return tag_values, remaining_content
-    
     
     @classmethod
     def parse_content_json(cls, content: str):
@@ -718,31 +685,307 @@ class HtmlParser:
     @staticmethod
     def parse_content_tag(content: str): 
         """
-        对内容进行预处理：
-        1. 将多个空格合并为单个空格。
-        2. 将换行符替换为空格。
-        3. 移除 `{}` 和 `[]` 符号周围的多余空格。
+        提取内容中所有标签的文本，并按标签名分组
+        
+        使用 ContentTagScanner 单次线性扫描，JSON 字符串中的 < 不会被当作标签
+        
+        Args:
+            content: 原始内容
+            
+        Returns:
+            (groups, remaining_content): groups 为 {标签名: [标签文本, ...]}，
+            remaining_content 为移除所有标签元素后剩余的内容
         """
-        # 对内容进行预处理
-        #content = HtmlParser.preprocess_content(content)
         groups = {}
-        soup = BeautifulSoup(content, 'html.parser')
-    
-        # 获取所有标签类型
-        tag_types = {tag.name for tag in soup.find_all(True)}
-    
-        # 遍历每种标签类型，提取对应的标签内容
-        for tag_type in tag_types:
-            # 提取标签的纯文本内容
-            tag_values = [tag.text for tag in soup.find_all(tag_type)]  # 提取纯文本内容
-            groups[tag_type] = tag_values
-    
-            # 删除已处理的标签
-            for tag in soup.find_all(tag_type):
-                tag.decompose()
-    
-        # 剩余未处理的内容
-        remaining_content = str(soup)
+        scanner = ContentTagScanner(content)
+        for tag_name, text in scanner:
+            groups.setdefault(tag_name, []).append(text)
+        return groups, scanner.remaining
+
+
+class ContentTagScanner:
+    """
+    内容标签扫描器
+    
+    单次向前扫描 AI 回复，按标签闭合顺序产出 (标签名, 标签文本)，标签文本包含嵌套标签的文本；
+    标签之外的内容收集到 remaining。内容以 { 或 [ 开头的标签按 JSON 处理，
+    其中字符串里的 < 不会被当作标签。未闭合的标签在内容结束时闭合，多余的结束标签被忽略。
+    """
+    
+    # 标签：<name ...>、</name>、<name/>
+    TAG_PATTERN = re.compile(r'<(/?)([A-Za-z][\w:.-]*)([^<>]*)>')
+    # JSON 内容中跳过字符串和普通字符，停在字符串外的 < 或未闭合的引号处
+    JSON_SKIP_PATTERN = re.compile(r'[^"<]*(?:"[^"\\\n]*(?:\\.[^"\\\n]*)*"[^"<]*)*')
+    # 判断标签内容是否为 JSON
+    JSON_START_PATTERN = re.compile(r'\s*[\[{]')
+    # 没有结束标签的 HTML 空元素
+    VOID_TAGS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                           'link', 'meta', 'param', 'source', 'track', 'wbr'])
+    
+    def __init__(self, content: str):
+        self.content = content or ''
+        self._remaining = []
+    
+    @property
+    def remaining(self) -> str:
+        """标签之外的内容（迭代结束后有效）"""
+        return ''.join(self._remaining)
+    
+    def __iter__(self):
+        content = self.content
+        length = len(content)
+        # 打开的标签: [标签名, 文本片段列表, 是否为 JSON 内容]
+        stack = []
+        pos = 0
+        
+        while pos < length:
+            # 找到下一个可能的标签起点
+            if stack and stack[-1][2]:
+                next_pos = self.JSON_SKIP_PATTERN.match(content, pos).end()
+                if next_pos < length and content[next_pos] == '"':
+                    # 未闭合的引号按普通字符处理
+                    next_pos += 1
+                    self._append_text(stack, content[pos:next_pos])
+                    pos = next_pos
+                    continue
+            else:
+                next_pos = content.find('<', pos)
+                if next_pos < 0:
+                    next_pos = length
+            
+            if next_pos > pos:
+                self._append_text(stack, content[pos:next_pos])
+            if next_pos >= length:
+                break
+            
+            match = self.TAG_PATTERN.match(content, next_pos)
+            if match is None:
+                # 不是标签的 <
+                self._append_text(stack, '<')
+                pos = next_pos + 1
+                continue
+            pos = match.end()
+            
+            closing, tag_name, attrs = match.group(1), match.group(2).lower(), match.group(3)
+            if closing:
+                # 闭合到最近的同名标签，中间未闭合的标签一并闭合；没有对应的开始标签时忽略
+                for index in range(len(stack) - 1, -1, -1):
+                    if stack[index][0] == tag_name:
+                        while len(stack) > index:
+                            yield self._close(stack)
+                        break
+            elif tag_name in self.VOID_TAGS or attrs.rstrip().endswith('/'):
+                yield tag_name, ''
+            else:
+                is_json = self.JSON_START_PATTERN.match(content, pos) is not None
+                stack.append([tag_name, [], is_json])
+        
+        # 未闭合的标签延伸到内容末尾
+        while stack:
+            yield self._close(stack)
+    
+    def _append_text(self, stack, text: str) -> None:
+        """将文本追加到所有打开的标签，没有打开的标签时作为剩余内容"""
+        if not stack:
+            self._remaining.append(text)
+            return
+        for element in stack:
+            element[1].append(text)
     
-        return groups, remaining_content
+    @staticmethod
+    def _close(stack):
+        """闭合最内层的标签，返回 (标签名, 标签文本)"""
+        tag_name, parts, _ = stack.pop()
+        return tag_name, html_unescape(''.join(parts))
 
+
+class IncrementalFormatter:
+    """
+    流式回复的增量格式化器
+    
+    逐行扫描输入并保存解析状态，一个块能确定不会与后续内容合并渲染时就立即格式化输出，
+    只有尚未闭合的尾部保持待定：
+    - 围栏代码块在遇到结束围栏时闭合；
+    - 其他块在空行之后遇到从行首开始的新段落时闭合；未闭合的 HTML 元素和注释、缩进内容（缩进代码块、
+      列表项续行）、后续列表项和引用块都会继续留在当前块中。
+    各块的 HTML 以空行分隔，与对完整内容调用 format_code_blocks 的结果一致。
+    引用式链接定义作用于整篇内容，出现后不再增量输出，flush 时返回完整内容的渲染结果并将 replace 置为 True。
+    """
+    
+    # 围栏代码块起始行（与 markdown2 fenced-code-blocks 一致）：``` 后可跟语言标识
+    FENCE_PATTERN = re.compile(r'^([ \t]*`{3,})[ \t]*[\w+-]*[ \t]*$')
+    # 列表项起始行
+    LIST_ITEM_PATTERN = re.compile(r'^[ \t]*(?:[*+-]|\d+\.)[ \t]+')
+    # 引用式链接定义行
+    REFERENCE_PATTERN = re.compile(r'^ {0,3}\[[^\]]+\]:[ \t]*\S')
+    # 行内可能跨越空行的结构：行内代码（其中的标签不计）、注释开始、开始或结束标签
+    LINE_TOKEN_PATTERN = re.compile(r'`[^`\n]+`|<!--|<(/?)(\w+)(?:\s+[^>]*)?>')
+    
+    def __init__(self, formatter=None):
+        """
+        Args:
+            formatter: 单个块的格式化函数，默认使用 HtmlParser.format_code_blocks
+        """
+        self.formatter = formatter or HtmlParser.format_code_blocks
+        self.replace = False     # flush 的结果是否为完整内容的渲染结果，应替换已输出的 HTML
+        self._source = []        # 已输入的全部内容
+        self._tail = ''          # 尚未遇到换行的最后一行
+        self._block = []         # 当前未闭合块的行
+        self._blank_lines = 0    # 当前块之后尚未确定归属的空行数
+        self._fence = None       # 当前所在围栏代码块的起始围栏（含缩进）
+        self._fence_block = False  # 当前块是否为独立的围栏代码块
+        self._in_list = False    # 当前块是否包含列表
+        self._open_tags = []     # 当前块中尚未闭合的 HTML 元素
+        self._in_comment = False  # 是否在未闭合的 HTML 注释中
+        self._emitted = False    # 是否已输出过块
+    
+    @property
+    def pending(self) -> str:
+        """尚未格式化的原始内容"""
+        lines = self._block + [''] * self._blank_lines + ([self._tail] if self._tail else [])
+        return '\n'.join(lines)
+    
+    def feed(self, chunk: str) -> str:
+        """
+        输入一段增量文本
+        
+        Args:
+            chunk: 增量文本
+            
+        Returns:
+            本次输入闭合的块格式化后的 HTML，没有闭合的块时返回空字符串
+        """
+        if not chunk:
+            return ''
+        self._source.append(chunk)
+        if self.replace:
+            return ''
+        lines = (self._tail + chunk).split('\n')
+        self._tail = lines.pop()
+        output = []
+        for line in lines:
+            self._process_line(line, output)
+            if self.replace:
+                return ''.join(output)
+        return ''.join(output)
+    
+    def flush(self) -> str:
+        """
+        流结束时格式化剩余内容
+        
+        Returns:
+            剩余内容格式化后的 HTML；replace 为 True 时为完整内容的渲染结果
+        """
+        output = []
+        if self._tail and not self.replace:
+            self._process_line(self._tail, output)
+            self._tail = ''
+        if self.replace:
+            return self.formatter(''.join(self._source))
+        self._emit_block(output)
+        return ''.join(output)
+    
+    def _process_line(self, line: str, output: list) -> None:
+        """处理一个完整的行"""
+        # 围栏代码块内：只检查结束围栏
+        if self._fence:
+            self._append_line(line)
+            if line.rstrip(' \t').endswith(self._fence):
+                self._fence = None
+                if self._fence_block:
+                    self._emit_block(output)
+            return
+        
+        if not line.strip():
+            if self._block:
+                self._blank_lines += 1
+            return
+        
+        if self.REFERENCE_PATTERN.match(line):
+            # 链接定义可能被之前或之后的内容引用，改为结束时整体渲染
+            self.replace = True
+            return
+        
+        match = self.FENCE_PATTERN.match(line)
+        if match and not self._has_open_construct():
+            # 从行首开始的围栏代码块与前面的内容分开渲染
+            if not line[0].isspace():
+                self._emit_block(output)
+            self._fence = match.group(1)
+            self._fence_block = not self._block
+            self._append_line(line)
+            return
+        
+        # 空行之后的新段落：当前块无法延续时输出当前块
+        if self._blank_lines and not self._continues_block(line):
+            self._emit_block(output)
+        self._append_line(line)
+        self._scan_line(line)
+    
+    def _append_line(self, line: str) -> None:
+        """将一行加入当前块，先补上之前的空行"""
+        if self._blank_lines:
+            self._block.extend([''] * self._blank_lines)
+            self._blank_lines = 0
+        if self.LIST_ITEM_PATTERN.match(line):
+            self._in_list = True
+        self._block.append(line)
+    
+    def _scan_line(self, line: str) -> None:
+        """更新当前块中未闭合的 HTML 元素和注释"""
+        pos = 0
+        while True:
+            if self._in_comment:
+                end = line.find('-->', pos)
+                if end < 0:
+                    return
+                self._in_comment = False
+                pos = end + 3
+            match = self.LINE_TOKEN_PATTERN.search(line, pos)
+            if match is None:
+                return
+            pos = match.end()
+            token = match.group(0)
+            if token == '<!--':
+                self._in_comment = True
+            elif token[0] == '`' or token.endswith('/>'):
+                continue
+            elif match.group(1):
+                # 结束标签闭合最近一个同名元素
+                name = match.group(2)
+                for index in range(len(self._open_tags) - 1, -1, -1):
+                    if self._open_tags[index] == name:
+                        del self._open_tags[index]
+                        break
+            elif match.group(2).lower() not in ContentTagScanner.VOID_TAGS:
+                self._open_tags.append(match.group(2))
+    
+    def _has_open_construct(self) -> bool:
+        """当前块中是否有尚未闭合的 HTML 元素或注释"""
+        return bool(self._open_tags) or self._in_comment
+    
+    def _continues_block(self, line: str) -> bool:
+        """空行之后的一行是否仍属于当前块"""
+        if line[0].isspace():
+            # 缩进代码块或列表项续行
+            return True
+        if self._in_list and self.LIST_ITEM_PATTERN.match(line):
+            return True
+        if line.startswith('>') and self._block[-1].lstrip().startswith('>'):
+            return True
+        return self._has_open_construct()
+    
+    def _emit_block(self, output: list) -> None:
+        """格式化并输出当前块"""
+        block = self._block
+        self._block = []
+        self._blank_lines = 0
+        self._fence = None
+        self._fence_block = False
+        self._in_list = False
+        self._open_tags = []
+        self._in_comment = False
+        text = '\n'.join(block)
+        if text.strip():
+            output.append(('\n\n' if self._emitted else '') + self.formatter(text))
+            self._emitted = True
@@ -0,0 +1,103 @@
+# ai_services/utils/http_session.py
+"""
+HTTP 会话池
+按 (服务, 代理, 单主机连接上限) 复用 aiohttp.ClientSession，
+保持长连接并缓存 DNS，避免每次请求重新建立 TCP/TLS 连接
+"""
+import asyncio
+from typing import Dict, Optional, Set, Tuple
+
+import aiohttp
+
+# 连接池默认参数
+DEFAULT_POOL_LIMIT = 100        # 连接池总连接数上限
+DEFAULT_LIMIT_PER_HOST = 10     # 单个主机的连接数上限
+DEFAULT_DNS_CACHE_TTL = 300     # DNS 缓存时间（秒）
+DEFAULT_KEEPALIVE_TIMEOUT = 60  # 空闲连接保活时间（秒）
+
+# 会话注册表: (service_id, proxy, limit_per_host) -> (session, 所属事件循环)
+_sessions: Dict[Tuple[str, str, int], Tuple[aiohttp.ClientSession, asyncio.AbstractEventLoop]] = {}
+# 正在关闭被替换会话的任务（保留引用，避免任务在完成前被垃圾回收）
+_closing_tasks: Set[asyncio.Task] = set()
+
+
+def get_session(service_id: str, proxy: Optional[str] = None,
+                limit_per_host: Optional[int] = None) -> aiohttp.ClientSession:
+    """
+    获取共享的 HTTP 会话，不存在、已关闭或属于其他事件循环时创建新会话，旧会话随之关闭
+
+    必须在事件循环中调用。调用方不要关闭返回的会话，统一由 close_all_sessions 关闭。
+
+    Args:
+        service_id: 服务ID，不同服务使用独立的连接池
+        proxy: 代理地址，不同代理使用独立的连接池
+        limit_per_host: 单个主机的连接数上限，为空时使用默认值
+
+    Returns:
+        aiohttp.ClientSession 对象
+    """
+    loop = asyncio.get_running_loop()
+    limit_per_host = int(limit_per_host) if limit_per_host else DEFAULT_LIMIT_PER_HOST
+    key = (service_id, proxy or "", limit_per_host)
+
+    entry = _sessions.get(key)
+    if entry is not None:
+        session, session_loop = entry
+        if not session.closed and session_loop is loop:
+            return session
+        _discard_session(session, session_loop, loop)
+
+    connector = aiohttp.TCPConnector(
+        limit=DEFAULT_POOL_LIMIT,
+        limit_per_host=limit_per_host,
+        use_dns_cache=True,
+        ttl_dns_cache=DEFAULT_DNS_CACHE_TTL,
+        keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT
+    )
+    session = aiohttp.ClientSession(connector=connector)
+    _sessions[key] = (session, loop)
+    return session
+
+
+def _discard_session(session: aiohttp.ClientSession, session_loop: asyncio.AbstractEventLoop,
+                     loop: asyncio.AbstractEventLoop) -> None:
+    """
+    关闭被替换的会话，释放其连接器中的连接
+
+    Args:
+        session: 被替换的会话
+        session_loop: 会话所属的事件循环
+        loop: 当前事件循环
+    """
+    if session.closed:
+        return
+    if session_loop.is_running() and not session_loop.is_closed():
+        # 所属事件循环仍在其他线程中运行，在该循环中关闭
+        asyncio.run_coroutine_threadsafe(_close_session(session), session_loop)
+    else:
+        # 所属事件循环已停止，连接在 close 中同步关闭，等待阶段的错误忽略
+        task = loop.create_task(_close_session(session))
+        _closing_tasks.add(task)
+        task.add_done_callback(_closing_tasks.discard)
+
+
+async def _close_session(session: aiohttp.ClientSession) -> None:
+    """关闭会话，失败时只记录错误"""
+    try:
+        await session.close()
+    except Exception as e:
+        print(f"关闭 HTTP 会话失败: {str(e)}")
+
+
+async def close_all_sessions(app=None) -> None:
+    """
+    关闭所有共享会话，可直接注册到 aiohttp 应用的 on_cleanup 信号
+
+    Args:
+        app: aiohttp 应用对象（on_cleanup 回调参数，未使用）
+    """
+    entries = list(_sessions.values())
+    _sessions.clear()
+    for session, _ in entries:
+        if not session.closed:
+            await _close_session(session)
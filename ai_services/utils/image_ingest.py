@@ -0,0 +1,243 @@
+# ai_services/utils/image_ingest.py
+"""
+图片读取与编码
+并发获取消息中的所有图片（ComfyUI /api/view 或本地文件），在专用线程池中缩放和转码
+（Pillow 解码和缩放时释放 GIL，无需在 ComfyUI 进程中启动子进程），
+在线程池中读取文件和 base64 编码，编码结果按图片内容和预处理参数缓存，
+多轮对话中重复发送同一张图片时无需重新处理
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+from urllib.parse import urlparse
+
+from PIL import Image, ImageOps
+
+from .http_session import get_session
+
+# 同时获取的图片数上限
+IMAGE_FETCH_CONCURRENCY = 4
+# 编码结果缓存条数上限
+IMAGE_CACHE_SIZE = 32
+# 图片预处理线程数
+IMAGE_PREPROCESS_WORKERS = 2
+
+# 图片预处理默认参数
+DEFAULT_IMAGE_MAX_SIZE = 1280       # 长边最大像素，0 表示不缩放
+DEFAULT_IMAGE_FORMAT = "JPEG"       # 输出格式：JPEG / WEBP / ORIGINAL（保持原格式）
+DEFAULT_IMAGE_QUALITY = 85          # JPEG / WEBP 压缩质量
+
+
+@dataclass(frozen=True)
+class ImagePreprocessOptions:
+    """图片预处理参数（不可变，同时作为缓存键的一部分）"""
+    max_size: int = DEFAULT_IMAGE_MAX_SIZE
+    image_format: str = DEFAULT_IMAGE_FORMAT
+    quality: int = DEFAULT_IMAGE_QUALITY
+
+
+def preprocess_image(image_data: bytes, options: ImagePreprocessOptions) -> Tuple[str, bytes]:
+    """
+    缩放并转码图片（在线程池中执行）
+
+    图片不超过最大尺寸且已是目标格式时原样返回，无法识别或无法解码（如文件不完整）的数据原样返回
+
+    Args:
+        image_data: 原始图片内容
+        options: 预处理参数
+
+    Returns:
+        (MIME 类型, 处理后的图片内容)
+    """
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        image.size  # 触发读取图片头
+    except Exception:
+        return "image/jpeg", image_data
+
+    with image:
+        source_format = image.format or "JPEG"
+        target_format = options.image_format.upper()
+        if target_format == "ORIGINAL":
+            target_format = source_format
+        needs_resize = options.max_size > 0 and max(image.size) > options.max_size
+
+        if not needs_resize and target_format == source_format:
+            return Image.MIME.get(source_format, "image/jpeg"), image_data
+
+        try:
+            image = ImageOps.exif_transpose(image)
+            if needs_resize:
+                image.thumbnail((options.max_size, options.max_size), Image.LANCZOS)
+
+            # JPEG 不支持透明通道，透明部分以白色填充
+            if target_format == "JPEG" and image.mode != "RGB":
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+
+            buffer = io.BytesIO()
+            if target_format in ("JPEG", "WEBP"):
+                image.save(buffer, format=target_format, quality=options.quality)
+            else:
+                image.save(buffer, format=target_format)
+        except Exception as e:
+            # 图片头可读但像素数据损坏或不完整，原样发送
+            print(f"图片预处理失败，使用原图: {str(e)}")
+            return Image.MIME.get(source_format, "image/jpeg"), image_data
+        return Image.MIME.get(target_format, "image/jpeg"), buffer.getvalue()
+
+
+class ImageIngestor:
+    """图片读取器：并发获取、专用线程池预处理、线程池编码、按内容缓存编码结果"""
+
+    def __init__(self, concurrency: int = IMAGE_FETCH_CONCURRENCY, cache_size: int = IMAGE_CACHE_SIZE,
+                 preprocess_workers: int = IMAGE_PREPROCESS_WORKERS):
+        self.concurrency = concurrency
+        self.cache_size = cache_size
+        self.preprocess_workers = preprocess_workers
+        # (内容哈希, 预处理参数) -> data URL
+        self._cache: "OrderedDict[Tuple[str, ImagePreprocessOptions], str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._preprocess_pool: Optional[ThreadPoolExecutor] = None
+
+    async def ingest(self, image_paths: List[str], host_url=None,
+                     options: Optional[ImagePreprocessOptions] = None) -> List[str]:
+        """
+        并发处理多张图片，结果顺序与输入一致
+
+        Args:
+            image_paths: 图片路径或 URL 列表
+            host_url: 主机 URL（用于处理相对路径）
+            options: 图片预处理参数，为空时使用默认参数
+
+        Returns:
+            处理后的图片数据列表（data URL 或原始 URL）
+        """
+        return list(await asyncio.gather(*(self.ingest_one(path, host_url, options) for path in image_paths)))
+
+    async def ingest_one(self, image_path: str, host_url=None,
+                         options: Optional[ImagePreprocessOptions] = None) -> str:
+        """
+        处理单张图片，将本地路径或 ComfyUI 图片缩放转码后转换为 base64，外部 URL 原样返回
+
+        Args:
+            image_path: 图片路径或 URL
+            host_url: 主机 URL（用于处理相对路径）
+            options: 图片预处理参数，为空时使用默认参数
+
+        Returns:
+            处理后的图片数据（base64 或 URL）
+        """
+        try:
+            # 检查是否是完整的外部 URL
+            parsed = urlparse(image_path)
+            if parsed.scheme in ('http', 'https') and not host_url:
+                return image_path
+
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self.concurrency)
+            loop = asyncio.get_running_loop()
+
+            async with self._semaphore:
+                if image_path.startswith('/api/view') and host_url:
+                    # 处理 ComfyUI API 格式的 URL
+                    base_path = image_path.split('&amp;rand=')[0]  # 移除随机参数
+                    full_url = f"{str(host_url).rstrip('/')}{base_path}"
+
+                    # 获取图片内容（本机 ComfyUI 使用独立的共享会话，不走代理）
+                    session = get_session("comfyui")
+                    async with session.get(full_url) as response:
+                        if response.status != 200:
+                            raise Exception(f"获取图片失败: HTTP {response.status}")
+                        image_data = await response.read()
+
+                elif os.path.isfile(image_path):
+                    # 处理本地文件
+                    image_data = await loop.run_in_executor(None, self._read_file, image_path)
+                else:
+                    raise Exception(f"无效的图片路径: {image_path}")
+
+                return await self._encode(image_data, options or ImagePreprocessOptions())
+
+        except Exception as e:
+            raise Exception(f"处理图片失败: {str(e)}")
+
+    def clear_cache(self) -> None:
+        """清空编码结果缓存"""
+        with self._lock:
+            self._cache.clear()
+
+    def shutdown(self) -> None:
+        """关闭图片预处理线程池"""
+        if self._preprocess_pool is not None:
+            self._preprocess_pool.shutdown(wait=False, cancel_futures=True)
+            self._preprocess_pool = None
+
+    async def _encode(self, image_data: bytes, options: ImagePreprocessOptions) -> str:
+        """预处理并编码图片，命中缓存时直接返回"""
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, self._digest, image_data)
+        key = (digest, options)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached
+
+        mime_type, image_data = await self._preprocess(image_data, options)
+        data_url = await loop.run_in_executor(None, self._to_data_url, mime_type, image_data)
+
+        with self._lock:
+            self._cache[key] = data_url
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return data_url
+
+    async def _preprocess(self, image_data: bytes, options: ImagePreprocessOptions) -> Tuple[str, bytes]:
+        """在专用线程池中预处理图片，限制同时解码的图片数且不占用默认线程池"""
+        if self._preprocess_pool is None:
+            self._preprocess_pool = ThreadPoolExecutor(max_workers=self.preprocess_workers,
+                                                       thread_name_prefix="image_preprocess")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._preprocess_pool, preprocess_image, image_data, options)
+
+    @staticmethod
+    def _read_file(image_path: str) -> bytes:
+        """读取本地图片（在线程池中执行）"""
+        with open(image_path, 'rb') as image_file:
+            return image_file.read()
+
+    @staticmethod
+    def _digest(image_data: bytes) -> str:
+        """计算图片内容哈希（在线程池中执行）"""
+        return hashlib.sha256(image_data).hexdigest()
+
+    @staticmethod
+    def _to_data_url(mime_type: str, image_data: bytes) -> str:
+        """将图片内容编码为 data URL（在线程池中执行）"""
+        encoded_string = base64.b64encode(image_data).decode('utf-8')
+        return f"data:{mime_type};base64,{encoded_string}"
+
+
+# 全局图片读取器
+image_ingestor = ImageIngestor()
+
+
+async def shutdown_image_ingestor(app=None) -> None:
+    """
+    关闭图片预处理线程池，可直接注册到 aiohttp 应用的 on_cleanup 信号
+
+    Args:
+        app: aiohttp 应用对象（on_cleanup 回调参数，未使用）
+    """
+    image_ingestor.shutdown()
@@ -0,0 +1,87 @@
+# ai_services/utils/model_cache.py
+"""
+模型列表缓存
+按服务缓存 get_models 的结果：有效期内直接返回；过期后先返回旧列表并在后台刷新；
+同一服务的并发请求共享同一次获取
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# 模型列表有效期（秒）
+MODEL_CACHE_TTL = 600
+
+
+class ModelListCache:
+    """模型列表缓存（single-flight + stale-while-revalidate）"""
+
+    def __init__(self, ttl: float = MODEL_CACHE_TTL):
+        self.ttl = ttl
+        # service_id -> {"models": 模型列表, "fetched_at": 获取时间}
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        # service_id -> 正在进行的获取任务
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def get(self, service_id: str, fetch: Callable[[], Awaitable[List[Dict]]]) -> List[Dict]:
+        """
+        获取模型列表
+
+        Args:
+            service_id: 服务ID
+            fetch: 获取模型列表的协程函数，如 service.get_models
+
+        Returns:
+            模型列表
+        """
+        entry = self._entries.get(service_id)
+        if entry is not None:
+            # 过期时后台刷新，本次返回旧列表
+            if time.monotonic() - entry["fetched_at"] >= self.ttl:
+                self._start_fetch(service_id, fetch)
+            return entry["models"]
+
+        # 没有缓存时等待获取完成；shield 保证调用方取消时不影响其他等待者
+        return await asyncio.shield(self._start_fetch(service_id, fetch))
+
+    def invalidate(self, service_id: Optional[str] = None) -> None:
+        """使缓存失效，service_id 为空时清空所有服务"""
+        if service_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(service_id, None)
+
+    def _start_fetch(self, service_id: str, fetch: Callable[[], Awaitable[List[Dict]]]) -> asyncio.Task:
+        """启动获取任务，已有进行中的任务时直接复用"""
+        task = self._inflight.get(service_id)
+        if task is None or task.done():
+            task = asyncio.get_running_loop().create_task(self._fetch(service_id, fetch))
+            # 后台刷新或等待者全部取消时没有人读取结果，在回调中读取异常避免 asyncio 报告未处理的异常
+            task.add_done_callback(self._consume_exception)
+            self._inflight[service_id] = task
+        return task
+
+    @staticmethod
+    def _consume_exception(task: asyncio.Task) -> None:
+        """读取获取任务的异常"""
+        if not task.cancelled():
+            task.exception()
+
+    async def _fetch(self, service_id: str, fetch: Callable[[], Awaitable[List[Dict]]]) -> List[Dict]:
+        """获取模型列表并写入缓存，失败时保留旧列表"""
+        try:
+            models = await fetch()
+        except Exception as e:
+            entry = self._entries.get(service_id)
+            if entry is None:
+                raise
+            print(f"刷新模型列表失败，继续使用缓存: {str(e)}")
+            return entry["models"]
+        finally:
+            self._inflight.pop(service_id, None)
+
+        self._entries[service_id] = {"models": models, "fetched_at": time.monotonic()}
+        return models
+
+
+# 全局模型列表缓存
+model_list_cache = ModelListCache()
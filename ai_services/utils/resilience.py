@@ -0,0 +1,182 @@
+# ai_services/utils/resilience.py
+"""
+上游请求限速与重试
+按 (服务, API 密钥) 使用令牌桶控制请求速率；可重试的失败（429、5xx、连接错误）
+在总截止时间内按带随机抖动的指数退避重试，并遵循上游返回的 Retry-After
+"""
+import asyncio
+import hashlib
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import aiohttp
+
+# 默认令牌桶参数：每秒请求数和突发容量，速率为 0 表示不限速
+DEFAULT_RATE_LIMIT = 2.0
+DEFAULT_RATE_BURST = 5
+
+# 默认重试参数
+DEFAULT_MAX_RETRIES = 3
+RETRY_BASE_DELAY = 0.5      # 首次重试的最大等待时间（秒）
+RETRY_MAX_DELAY = 8.0       # 单次重试的最大等待时间（秒）
+
+# 可重试的 HTTP 状态码
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class UpstreamHTTPError(Exception):
+    """上游服务返回错误状态码"""
+
+    def __init__(self, status: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    解析 Retry-After 响应头
+
+    Args:
+        value: 秒数或 HTTP 日期
+
+    Returns:
+        需要等待的秒数，无法解析时返回 None
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """判断错误是否可以重试：可重试的状态码或连接错误"""
+    if isinstance(error, UpstreamHTTPError):
+        return error.status in RETRYABLE_STATUS
+    return isinstance(error, aiohttp.ClientConnectionError)
+
+
+class TokenBucket:
+    """令牌桶：按固定速率补充令牌，请求按到达顺序预约令牌并等待"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    async def acquire(self, deadline: Optional[float] = None) -> None:
+        """
+        获取一个令牌，令牌不足时等待
+
+        Args:
+            deadline: 总截止时间（time.monotonic 时间），为空时不限制等待时间
+
+        Raises:
+            asyncio.TimeoutError: 等待令牌会超过截止时间
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        # 先预约令牌（可为负数），按欠缺的令牌数计算等待时间，后到的请求等待更久
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return
+        delay = -self.tokens / self.rate
+        if deadline is not None and now + delay > deadline:
+            # 不占用令牌，避免影响后续请求
+            self.tokens += 1
+            raise asyncio.TimeoutError(f"请求过于频繁，需要等待 {delay:.1f} 秒，超过请求超时时间")
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            # 取消时归还预约的令牌
+            self.tokens += 1
+            raise
+
+
+# 令牌桶注册表: (service_id, API 密钥哈希) -> TokenBucket
+_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+
+
+def get_token_bucket(service_id: str, api_key: str, rate: float, burst: int) -> TokenBucket:
+    """
+    获取服务和 API 密钥对应的令牌桶，不存在时创建；参数变化时更新
+
+    Args:
+        service_id: 服务ID
+        api_key: API 密钥，不同密钥的限额互不影响
+        rate: 每秒请求数
+        burst: 突发容量
+
+    Returns:
+        TokenBucket 对象
+    """
+    key = (service_id, hashlib.sha256((api_key or "").encode('utf-8')).hexdigest())
+    bucket = _buckets.get(key)
+    if bucket is None:
+        bucket = _buckets[key] = TokenBucket(rate, burst)
+    else:
+        bucket.rate = rate
+        bucket.capacity = burst
+    return bucket
+
+
+def get_retry_delay(attempt: int, error: Exception) -> float:
+    """
+    计算第 attempt 次重试前的等待时间：带完全随机抖动的指数退避，不短于 Retry-After
+
+    Args:
+        attempt: 已重试次数（从 0 开始）
+        error: 本次失败的错误
+
+    Returns:
+        等待秒数
+    """
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after:
+        delay = max(delay, retry_after)
+    return delay
+
+
+async def call_with_retry(func: Callable[[], Awaitable[Any]], deadline: float,
+                          max_retries: int = DEFAULT_MAX_RETRIES,
+                          is_retryable: Callable[[Exception], bool] = is_retryable_error) -> Any:
+    """
+    调用 func，可重试的失败在截止时间内退避重试
+
+    Args:
+        func: 发起一次请求的协程函数
+        deadline: 总截止时间（time.monotonic 时间）
+        max_retries: 最大重试次数
+        is_retryable: 判断错误是否可以重试的函数
+
+    Returns:
+        func 的结果
+
+    Raises:
+        最后一次失败的错误
+    """
+    attempt = 0
+    while True:
+        try:
+            return await func()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = get_retry_delay(attempt, e)
+            if time.monotonic() + delay >= deadline:
+                raise
+            print(f"上游请求失败，{delay:.1f} 秒后第 {attempt + 1} 次重试: {str(e)}")
+            await asyncio.sleep(delay)
+            attempt += 1
@@ -0,0 +1,189 @@
+# ai_services/utils/scheduler.py
+"""
+服务请求调度
+限制每个服务同时进行的上游调用数，超出的请求按优先级和到达顺序排队，
+队列已满时立即拒绝，避免突发请求耗尽上游限额或阻塞 ComfyUI 事件循环
+"""
+import asyncio
+import bisect
+import itertools
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+# 默认每个服务同时进行的调用数上限
+DEFAULT_MAX_IN_FLIGHT = 4
+# 默认每个服务的排队请求数上限
+DEFAULT_MAX_QUEUED = 16
+# 请求可指定的优先级范围，数值越小越先执行；默认优先级为最高，客户端只能主动降低自己的优先级
+MIN_PRIORITY = 0
+MAX_PRIORITY = 9
+
+
+def clamp_priority(priority) -> int:
+    """将客户端传入的优先级限制在允许范围内，无效值按默认优先级处理"""
+    try:
+        priority = int(priority)
+    except (TypeError, ValueError):
+        return MIN_PRIORITY
+    return min(max(priority, MIN_PRIORITY), MAX_PRIORITY)
+
+
+class QueueFullError(Exception):
+    """排队请求数已达上限"""
+
+
+class Ticket:
+    """一次调用的排队凭证，获得执行权后必须调用 release 释放"""
+
+    def __init__(self, scheduler: "ServiceScheduler", key: Tuple[int, int]):
+        self.scheduler = scheduler
+        self.key = key
+        self.granted = False
+        self.released = False
+        # 最近一次产出的排队位置，位置不变时不再通知
+        self.last_position: Optional[int] = None
+        self._changed = asyncio.Event()
+
+    @property
+    def position(self) -> int:
+        """当前排队位置（从 1 开始），已获得执行权时为 0"""
+        if self.granted:
+            return 0
+        return self.scheduler.get_position(self) + 1
+
+    async def positions(self) -> AsyncIterator[int]:
+        """
+        等待执行权，排队位置变化时产出新位置，获得执行权后结束
+
+        Yields:
+            排队位置（从 1 开始）
+        """
+        while not self.granted:
+            self._changed.clear()
+            position = self.position
+            if position != self.last_position:
+                self.last_position = position
+                yield position
+            await self._changed.wait()
+
+    async def wait(self) -> None:
+        """等待执行权"""
+        async for _ in self.positions():
+            pass
+
+    def release(self) -> None:
+        """释放执行权，仍在排队时退出队列，可重复调用"""
+        if not self.released:
+            self.released = True
+            self.scheduler.release(self)
+
+    def notify(self) -> None:
+        """通知排队状态已变化"""
+        self._changed.set()
+
+
+class ServiceScheduler:
+    """单个服务的调度器：并发上限 + 优先级队列 + 队列长度上限"""
+
+    def __init__(self, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, max_queued: int = DEFAULT_MAX_QUEUED):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.in_flight = 0
+        # 按 (优先级, 到达序号) 排序的排队凭证
+        self._waiting: List[Ticket] = []
+        self._counter = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        """排队中的请求数"""
+        return len(self._waiting)
+
+    def enqueue(self, priority: int = 0) -> Ticket:
+        """
+        申请执行权，有空闲名额时立即获得，否则进入队列
+
+        Args:
+            priority: 优先级，数值越小越先执行，相同优先级按到达顺序；限制在 MIN_PRIORITY 到 MAX_PRIORITY 之间
+
+        Returns:
+            Ticket 对象
+
+        Raises:
+            QueueFullError: 队列已满
+        """
+        ticket = Ticket(self, (clamp_priority(priority), next(self._counter)))
+        if self.in_flight < self.max_in_flight and not self._waiting:
+            ticket.granted = True
+            self.in_flight += 1
+            return ticket
+
+        if len(self._waiting) >= self.max_queued:
+            raise QueueFullError(f"请求过多，排队人数已达上限 {self.max_queued}，请稍后重试")
+
+        keys = [waiting.key for waiting in self._waiting]
+        index = bisect.bisect(keys, ticket.key)
+        self._waiting.insert(index, ticket)
+        # 插队时其后请求的排队位置后移
+        self._notify_waiting(index + 1)
+        return ticket
+
+    def set_limits(self, max_in_flight: int, max_queued: int) -> None:
+        """更新并发和队列上限，并发上限调大时立即让排队请求开始执行"""
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self._dispatch()
+
+    def get_position(self, ticket: Ticket) -> int:
+        """获取排队凭证在队列中的下标"""
+        return self._waiting.index(ticket)
+
+    def release(self, ticket: Ticket) -> None:
+        """释放执行权或退出队列，并让队首请求获得执行权"""
+        if ticket.granted:
+            self.in_flight -= 1
+        elif ticket in self._waiting:
+            self._waiting.remove(ticket)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """将空闲名额分配给队首请求，并通知排队位置发生变化的请求"""
+        while self._waiting and self.in_flight < self.max_in_flight:
+            ticket = self._waiting.pop(0)
+            ticket.granted = True
+            self.in_flight += 1
+            ticket.notify()
+        self._notify_waiting()
+
+    def _notify_waiting(self, start: int = 0) -> None:
+        """通知从 start 开始排队位置与上次产出不同的请求"""
+        for index in range(start, len(self._waiting)):
+            ticket = self._waiting[index]
+            if ticket.last_position != index + 1:
+                ticket.notify()
+
+
+# 调度器注册表: service_id -> ServiceScheduler
+_schedulers: Dict[str, ServiceScheduler] = {}
+
+
+def get_scheduler(service_id: str, max_in_flight: Optional[int] = None,
+                  max_queued: Optional[int] = None) -> ServiceScheduler:
+    """
+    获取服务的调度器，不存在时创建；传入的上限与当前值不同时更新
+
+    Args:
+        service_id: 服务ID
+        max_in_flight: 同时进行的调用数上限，为空时使用默认值
+        max_queued: 排队请求数上限，为空时使用默认值
+
+    Returns:
+        ServiceScheduler 对象
+    """
+    max_in_flight = int(max_in_flight) if max_in_flight else DEFAULT_MAX_IN_FLIGHT
+    max_queued = int(max_queued) if max_queued is not None else DEFAULT_MAX_QUEUED
+
+    scheduler = _schedulers.get(service_id)
+    if scheduler is None:
+        scheduler = _schedulers[service_id] = ServiceScheduler(max_in_flight, max_queued)
+    elif (scheduler.max_in_flight, scheduler.max_queued) != (max_in_flight, max_queued):
+        scheduler.set_limits(max_in_flight, max_queued)
+    return scheduler
@@ -0,0 +1,60 @@
+# ai_services/utils/sse.py
+"""
+SSE (Server-Sent Events) 工具
+解析上游服务的 SSE 响应，以及生成返回给浏览器的 SSE 事件
+"""
+import json
+from typing import Any, AsyncIterator, Tuple
+
+
+async def iter_sse_events(response) -> AsyncIterator[Tuple[str, str]]:
+    """
+    逐个解析 aiohttp 响应中的 SSE 事件
+
+    Args:
+        response: aiohttp.ClientResponse 对象
+
+    Yields:
+        (event, data) 元组，event 缺省为 "message"，多行 data 以换行连接
+    """
+    event = None
+    data_lines = []
+    async for raw_line in response.content:
+        line = raw_line.decode('utf-8').rstrip('\r\n')
+
+        # 空行表示一个事件结束
+        if not line:
+            if data_lines:
+                yield event or 'message', '\n'.join(data_lines)
+            event = None
+            data_lines = []
+            continue
+
+        # 注释行（如 DashScope 的 :HTTP_STATUS/200）
+        if line.startswith(':'):
+            continue
+
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'event':
+            event = value
+        elif field == 'data':
+            data_lines.append(value)
+
+    if data_lines:
+        yield event or 'message', '\n'.join(data_lines)
+
+
+def format_sse_event(payload: Any) -> bytes:
+    """
+    生成一条 SSE data 事件
+
+    Args:
+        payload: 事件数据，字符串原样发送，其他类型序列化为 JSON
+
+    Returns:
+        编码后的事件字节串
+    """
+    data = payload if isinstance(payload, str) else json.dumps(payload)
+    return f'data: {data}\n\n'.encode('utf-8')
@@ -0,0 +1,130 @@
+"""
+HtmlParser.format_code_blocks 性能测试示例
+对比旧的渲染流程（markdown2 + pygments + html5lib + bs4 重建代码块）与当前实现的单条消息渲染耗时
+"""
+import re
+import sys
+import time
+from pathlib import Path
+
+import markdown2
+from bs4 import BeautifulSoup
+
+# 添加项目根目录到系统路径
+current_dir = Path(__file__).parent
+project_root = current_dir.parent
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+from ai_services.utils.html_parser import HtmlParser
+
+# 每条消息的渲染次数
+ROUNDS = 20
+
+# 测试用的 AI 回复
+short_reply = """好的，下面是一个读取图片尺寸的示例：
+
+```python
+from PIL import Image
+
+with Image.open("input.png") as image:
+    print(image.size)
+```
+
+运行后会输出 `(宽, 高)`。"""
+
+code_reply = "\n\n".join(
+    f"""### 第 {i + 1} 步
+
+这一步处理 **第 {i + 1} 批** 数据，注意 `batch_size` 不能超过显存限制：
+
+```python
+def process_batch_{i}(images, batch_size=4):
+    results = []
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        if len(batch) < batch_size:
+            print("最后一批 < batch_size")
+        results.extend(model(batch))
+    return results
+```
+
+- 输入：图片列表
+- 输出：处理结果列表"""
+    for i in range(12)
+)
+
+html_reply = """工作流已生成，点击下面的按钮加载：
+
+<div class="workflow-card"><span class="title">文生图工作流</span>
+<button class="load-button" onclick="loadWorkflow(this)">加载工作流</button></div>
+
+```json
+{"nodes": [{"id": 1, "type": "CheckpointLoaderSimple"}, {"id": 2, "type": "KSampler", "widgets_values": [42, "fixed", 20, 7.5]}]}
+```
+
+<span class="hint">提示：加载前请先保存当前工作流</span>"""
+
+REPLIES = {
+    "short": short_reply,
+    "code": code_reply,
+    "html": html_reply,
+}
+
+
+def legacy_format_code_blocks(content: str) -> str:
+    """旧的渲染流程（仅用于对比）"""
+    protected_blocks = {}
+    block_id = 0
+
+    def protect_existing_code_blocks(match):
+        nonlocal block_id
+        placeholder = f"__PROTECTED_CODE_BLOCK_{block_id}__"
+        protected_blocks[placeholder] = match.group(0)
+        block_id += 1
+        return placeholder
+
+    def protect_html_elements(match):
+        nonlocal block_id
+        if match.group(1).lower() in ['pre', 'code']:
+            return match.group(0)
+        placeholder = f"__PROTECTED_HTML_{block_id}__"
+        protected_blocks[placeholder] = match.group(0)
+        block_id += 1
+        return placeholder
+
+    content = re.sub(r'<div\s+class=["\']code-block["\'][^>]*>[\s\S]*?</div>', protect_existing_code_blocks, content)
+    content = re.sub(r'<(\w+)(?:\s+[^>]*)?(?:>[\s\S]*?</\1>|/>)', protect_html_elements, content)
+    html_content = markdown2.markdown(content, extras=['fenced-code-blocks'])
+    soup = BeautifulSoup(html_content, 'html5lib')
+    for pre in soup.find_all('pre'):
+        code = pre.find('code')
+        if code and code.parent == pre:
+            lang = code.get('class', ['language-plaintext'])[0].replace('language-', '') if code.get('class') else 'plaintext'
+            code_content = code.get_text(strip=False).strip('\n\r\t ')
+            pre.replace_with(HtmlParser.create_code_block(code_content, lang))
+    result = str(soup.body).replace('<body>', '').replace('</body>', '')
+    for placeholder, original in protected_blocks.items():
+        result = result.replace(placeholder, original)
+    return result
+
+
+def measure(formatter, content: str) -> float:
+    """返回单条消息的平均渲染耗时（毫秒）"""
+    formatter(content)  # 预热
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        formatter(content)
+    return (time.perf_counter() - start) / ROUNDS * 1000
+
+
+def main():
+    print(f"{'回复':<8}{'长度':>8}{'旧流程(ms)':>14}{'当前(ms)':>12}{'加速':>8}")
+    for name, content in REPLIES.items():
+        before = measure(legacy_format_code_blocks, content)
+        after = measure(HtmlParser.format_code_blocks, content)
+        print(f"{name:<8}{len(content):>8}{before:>14.2f}{after:>12.2f}{before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+增量格式化测试示例
+检查流式回复逐段格式化拼接后的 HTML 与对完整回复调用 format_code_blocks 的结果一致
+"""
+import sys
+from pathlib import Path
+
+# 添加项目根目录到系统路径
+current_dir = Path(__file__).parent
+project_root = current_dir.parent
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+from ai_services.utils.html_parser import HtmlParser, IncrementalFormatter
+
+# 测试用的 AI 回复
+CASES = {
+    "段落和代码块": "第一段\n第二行\n\n```python\nx = 1\n\ny = 2\n```\n\n最后一段",
+    "跨空行的 HTML 块": "开头\n\n<div>\n\ninner\n\n</div>\n\n结尾",
+    "跨空行的行内元素": "说明 <span class=\"hint\">第一部分\n\n第二部分</span> 完毕\n\n下一段",
+    "缩进代码块": "示例：\n\n    line 1\n\n    line 2\n\n    line 3\n\n说明",
+    "松散无序列表": "- 第一项\n\n- 第二项\n\n  续行\n\n- 第三项\n\n列表之后",
+    "松散有序列表": "1. 第一步\n\n2. 第二步\n\n3. 第三步",
+    "列表中的代码块": "1. 安装：\n\n   ```bash\n   pip install x\n   ```\n\n2. 运行\n\n结束",
+    "引用块": "> 第一段引用\n\n> 第二段引用\n\n正文",
+    "波浪线不是围栏": "~~~\ncode\n~~~\n\n后续",
+    "带语言的围栏": "```json\n{\"a\": \"<b>\"}\n```\n```\nplain\n```",
+    "空元素": "第一行<br>\n\n第二段<br/>\n\n第三段",
+    "跨空行的注释": "a\n\n<!-- x\n\ny -->\n\nb",
+    "引用式链接": "参见 [文档][doc]。\n\n[doc]: https://example.com/doc\n\n结束",
+}
+
+
+def render_incremental(content: str, chunk_size: int) -> str:
+    """按固定长度分段输入增量格式化器，返回客户端最终显示的 HTML（replace 时整体替换）"""
+    formatter = IncrementalFormatter()
+    parts = [formatter.feed(content[i:i + chunk_size]) for i in range(0, len(content), chunk_size)]
+    html = formatter.flush()
+    if formatter.replace:
+        return html
+    parts.append(html)
+    return ''.join(parts)
+
+
+def test_incremental_matches_full_render():
+    for name, content in CASES.items():
+        expected = HtmlParser.format_code_blocks(content)
+        for chunk_size in (1, 3, 7, len(content)):
+            assert render_incremental(content, chunk_size) == expected, f"{name} (分段长度 {chunk_size})"
+
+
+def test_closed_blocks_are_emitted_before_flush():
+    formatter = IncrementalFormatter()
+    assert formatter.feed("第一段\n\n") == ''
+    assert formatter.feed("第二段\n") == HtmlParser.format_code_blocks("第一段")
+    assert formatter.feed("\n```python\nx = 1\n```\n") != ''
+    assert formatter.pending == ''
+
+
+def test_long_open_html_block_is_linear():
+    formatter = IncrementalFormatter()
+    formatter.feed("<div>\n\n")
+    for i in range(2000):
+        assert formatter.feed(f"第 {i} 行 <span>x</span>\n\n") == ''
+    assert formatter._open_tags == ['div']
+    assert formatter.feed("</div>\n\n后续\n") != ''
+
+
+def main():
+    for name, content in CASES.items():
+        expected = HtmlParser.format_code_blocks(content)
+        actual = render_incremental(content, 1)
+        print(f"{'一致' if actual == expected else '不一致'}: {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -74,13 +74,15 @@ class AiService {
 
     /**
      * 获取历史记录
+     * @param {number} pageSize - 每页条数
+     * @param {number|null} lastMessageId - 分页游标（上一页返回的 next_id，即上一页最后一条记录的ID）
      * @returns {Promise<Array>} 历史记录数组
      */
     async getHistory(pageSize = 10, lastMessageId = null) {
         try {
             let url = `${this.baseUrl}/history?limit=${pageSize}`;
             if (lastMessageId) {
-                url += `&message_id=${lastMessageId}`;
+                url += `&before=${lastMessageId}`;
             }
             
             const response = await fetch(url);